@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Script to benchmark fetch.py against synthetic LABSTAT files served locally."""
+
+# modules
+from sys import version_info,executable,exit,path
+from os import makedirs,getcwd,utime
+from os.path import dirname,abspath,join
+from shutil import rmtree
+from random import Random
+from datetime import datetime
+from time import time
+from json import dump
+from re import match
+from subprocess import Popen,PIPE,STDOUT,check_output
+from threading import Thread
+from http.server import ThreadingHTTPServer,SimpleHTTPRequestHandler
+
+FETCH=join(dirname(dirname(abspath(__file__))),'src','fetch.py')
+path.insert(0,dirname(FETCH))
+from connections import parse,connect,release
+
+def generate(folder,section,items,areas,years,revisions,vintages,seed,dataonly=False):
+    """Write synthetic item, series and data files for a section, one folder per vintage, returning the row counts.
+
+    Each vintage after the first revises a fraction of the values and publishes one more month, which also moves the end
+    of every series in the series file unless only the data is to change."""
+    random,counts,started=Random(seed),[],time()
+    codes=["SX%04d" % n for n in range(items)]
+    regions=["0000"]+["A%03d" % n for n in range(1,areas)]
+    series=["%sUR%s%s" % (section.upper(),area,code) for area in regions for code in codes]
+    first=datetime.now().year-years+1
+    values={s:[100.0+random.random()*10] for s in series}
+
+    for vintage in range(vintages):
+        months=12*(years-1)+vintage+1 # the last year is filled in one month per vintage
+        path=join(folder,"v%d" % vintage,section)
+        makedirs(path,exist_ok=True)
+
+        with open(join(path,"%s.item" % section),"w",newline='') as itemfile:
+            itemfile.write("item_code\titem_name\tdisplay_level\tselectable\tsort_sequence\r\n")
+
+            for n,code in enumerate(codes):
+                itemfile.write("%s\tSynthetic item %d\t%d\tT\t%d\r\n" % (code,n,min(n,1),n+1))
+
+        with open(join(path,"%s.series" % section),"w",newline='') as seriesfile:
+            seriesfile.write("series_id\tarea_code\titem_code\tseasonal\tperiodicity_code\tbase_code\tbase_period\tseries_title\tfootnote_codes\tbegin_year\tbegin_period\tend_year\tend_period\r\n")
+
+            last=12*(years-1)+1 if dataonly else months
+
+            for s in series:
+                seriesfile.write("%-17s\t%s\t%s\tU\tR\tS\t1982-84=100\tSynthetic %s, not seasonally adjusted\t\t%d\tM01\t%d\tM%02d\r\n" % (
+                    s,s[4:8],s[8:],s,first,first+(last-1)//12,(last-1)%12+1
+                ))
+
+        rows=0
+
+        with open(join(path,"%s.data.0.Current" % section),"w",newline='') as datafile:
+            datafile.write("series_id        \tyear\tperiod\t       value\tfootnote_codes\r\n")
+
+            for s in series:
+                while len(values[s])<months:
+                    values[s].append(values[s][-1]*(1+random.gauss(0.002,0.005)))
+
+                if vintage>0: # revise some of the recent values
+                    for m in range(max(0,months-12),months-1):
+                        if random.random()<revisions:
+                            values[s][m]*=1+random.gauss(0,0.001)
+
+                for m in range(months):
+                    datafile.write("%-17s\t%d\tM%02d\t%12.3f\t\r\n" % (s,first+m//12,m%12+1,values[s][m]))
+                    rows+=1
+
+        for name in ["item","series","data.0.Current"]: # a minute apart, so conditional requests see each vintage as newer
+            utime(join(path,"%s.%s" % (section,name)),(started+60*vintage,started+60*vintage))
+
+        counts.append({'items':len(codes),'series':len(series),'rows':rows})
+        print("Generated vintage %d of section '%s' in %s: %d items, %d series, %d rows." % (vintage,section,path,len(codes),len(series),rows))
+
+    return counts
+
+class VintageHandler(SimpleHTTPRequestHandler):
+    """File handler serving the server's current vintage folder, without logging every request."""
+    def __init__(self,request,address,server):
+        super().__init__(request,address,server,directory=server.vintage)
+
+    def log_message(self,format,*args):
+        pass
+
+def serve(folder,port):
+    """Serve a folder over HTTP in a background thread, returning the server; set its vintage to change the folder."""
+    server=ThreadingHTTPServer(('127.0.0.1',port),VintageHandler)
+    server.vintage=folder
+    Thread(target=server.serve_forever,daemon=True).start()
+    return server
+
+def run(url,section,database,cache,options):
+    """Run fetch.py once against a URL, returning its wall time, exit status and per stage timings."""
+    command=[executable,FETCH,"--update","--database",database,"--url",url,"--cache",cache]+options+[section]
+    started,stages,deltas=time(),[],[]
+    process=Popen(command,stdout=PIPE,stderr=STDOUT,text=True)
+
+    for line in process.stdout:
+        m=match(r"Delta for LABSTAT section '(\w+)': (\d+) inserted, (\d+) changed, (\d+) unchanged, (\d+) deleted",line)
+
+        if m!=None:
+            deltas.append({
+                'section':m.group(1),
+                'inserted':int(m.group(2)),
+                'changed':int(m.group(3)),
+                'unchanged':int(m.group(4)),
+                'deleted':int(m.group(5)),
+            })
+
+        m=match(r"Stage (\w+) for LABSTAT section '(\w+)' from (\S+): downloaded in ([\d.]+)s, waited ([\d.]+)s, worked ([\d.]+)s\.",line)
+
+        if m!=None:
+            stages.append({
+                'stage':m.group(1),
+                'section':m.group(2),
+                'file':m.group(3),
+                'download':float(m.group(4)),
+                'wait':float(m.group(5)),
+                'work':float(m.group(6)),
+            })
+
+    return {'status':process.wait(),'elapsed':time()-started,'stages':stages,'deltas':deltas,'command':command[1:]}
+
+def history(database,section):
+    """Rows of a section's BLSTimeSeriesHistory, and dates of its series with more than one vintage of their value."""
+    database=parse(database,True)
+    connection=connect(database)
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""SELECT COUNT(*) AS n
+FROM BLSTimeSeriesHistory JOIN BLSSeries ON BLSSeries.series_id=BLSTimeSeriesHistory.series_id
+WHERE BLSSeries.section='%s'""" % section)
+            rows=cursor.fetchone()
+            cursor.execute("""SELECT COUNT(*) AS n FROM (
+    SELECT BLSTimeSeriesHistory.series_id,BLSTimeSeriesHistory.date
+    FROM BLSTimeSeriesHistory JOIN BLSSeries ON BLSSeries.series_id=BLSTimeSeriesHistory.series_id
+    WHERE BLSSeries.section='%s'
+    GROUP BY BLSTimeSeriesHistory.series_id,BLSTimeSeriesHistory.date
+    HAVING COUNT(*)>1
+) AS revised""" % section)
+            return {'rows':int(rows['n']),'revised':int(cursor.fetchone()['n'])}
+
+    finally:
+        release(database,connection)
+
+def main():
+    # arguments
+    from argparse import ArgumentParser
+    args=ArgumentParser();
+    args.add_argument("-D","--database",type=str,default="database=Benchmark",help='Database connection for fetch.py.')
+    args.add_argument("-f","--folder",type=str,default=join(getcwd(),"benchmark"),help="Folder for the synthetic files.")
+    args.add_argument("-S","--section",type=str,default='cu',help="Section the synthetic files imitate (must use the cu layout).")
+    args.add_argument("-i","--items",type=int,default=400,help="Items per area.")
+    args.add_argument("-a","--areas",type=int,default=25,help="Areas, so there are items times areas series.")
+    args.add_argument("-y","--years",type=int,default=10,help="Years of monthly data per series.")
+    args.add_argument("-r","--revisions",type=float,default=0.05,help="Fraction of the last year's values revised in each vintage.")
+    args.add_argument("-v","--vintages",type=int,default=2,help="Vintages to generate and load in turn.")
+    args.add_argument("-d","--dataonly",action='store_true',help="Set to keep the item and series files the same in every vintage, so later vintages change only the time series.")
+    args.add_argument("-s","--seed",type=int,default=1,help="Random seed.")
+    args.add_argument("-p","--port",type=int,default=8642,help="Port for the local HTTP server.")
+    args.add_argument("-o","--output",type=str,default="benchmark.json",help="File to write the JSON results to.")
+    args.add_argument("-n","--nogenerate",action='store_true',help="Set to reuse files generated by an earlier run.")
+    args.add_argument("-g","--generate",action='store_true',help="Set to only generate the files.")
+    args.add_argument("options",nargs='*',help="Further options for fetch.py, after --.")
+    args=args.parse_args();
+
+    # initialize
+    print(__doc__,"\nParameters:",vars(args))
+
+    try:
+        version=check_output(["git","-C",dirname(FETCH),"describe","--always","--dirty"],text=True).strip()
+
+    except Exception:
+        version=None
+
+    # generate
+    counts=None if args.nogenerate else generate(args.folder,args.section,args.items,args.areas,args.years,args.revisions,args.vintages,args.seed,args.dataonly)
+
+    if args.generate:
+        return 0
+
+    # load each vintage in turn from the same URL, so later ones exercise the download cache and delta loads
+    server,runs,status,started=serve(args.folder,args.port),[],0,datetime.now()
+    url,cache="http://127.0.0.1:%d/%%s" % args.port,join(args.folder,"cache")
+    rmtree(cache,ignore_errors=True)
+
+    try:
+        for vintage in range(args.vintages):
+            server.vintage=join(args.folder,"v%d" % vintage)
+            print("Loading vintage %d from %s" % (vintage,url))
+            result=run(url,args.section,args.database,cache,args.options)
+            result['vintage']=vintage
+
+            if counts!=None:
+                result.update(counts[vintage])
+                result['rows_per_second']=counts[vintage]['rows']/result['elapsed']
+
+            print("Vintage %d: status %d in %.2fs%s." % (
+                vintage,
+                result['status'],
+                result['elapsed'],
+                "".join(", delta of %d inserted, %d changed, %d unchanged rows" % (delta['inserted'],delta['changed'],delta['unchanged']) for delta in result['deltas'])
+            ))
+            runs.append(result)
+            status=status or result['status']
+
+    finally:
+        server.shutdown()
+
+    # every vintage of a revised value should survive in the history, which a cascading delete of the series loses
+    check=None
+
+    if status==0 and args.vintages>1:
+        check=history(args.database,args.section)
+        check['passed']=check['rows']>=(counts[0]['rows'] if counts!=None else 0) and (check['revised']>0 or args.revisions==0)
+        print("History: %d rows, %d dates with more than one vintage%s." % (check['rows'],check['revised'],"" if check['passed'] else ", which is too few"))
+        status=status or (0 if check['passed'] else 1)
+
+    # write results
+    with open(args.output,"w") as output:
+        dump({
+            'version':version,
+            'started':started.isoformat(),
+            'parameters':vars(args),
+            'runs':runs,
+            'history':check,
+        },output,indent=2)
+
+    print("Results written to %s" % args.output)
+    print("Done.")
+    return status
+
+# bootstrap
+if __name__ == "__main__":
+    assert(version_info.major>=3)
+    exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Script to smoke test fetch.py, export.py and labstat.py on each embedded backend, loading a few small synthetic
+vintages into a new database, exporting it and reading it back."""
+
+# modules
+from sys import version_info,executable,exit
+from os import getcwd,remove
+from os.path import dirname,join,exists
+from shutil import rmtree
+from subprocess import call,DEVNULL,STDOUT
+from benchmark import FETCH,generate,serve,run,history
+from connections import parse
+from labstat import Reader
+
+def check(server,kind,folder,section,vintages,options):
+    """Load every vintage, served by a server, into a new database of a kind, returning the failures found."""
+    filename=join(folder,"smoke.%s" % kind)
+    database,cache,failures="%s=%s" % (kind,filename),join(folder,"cache.%s" % kind),[]
+    url="http://127.0.0.1:%d/%%s" % server.server_address[1]
+    parquet=join(folder,"parquet.%s" % kind)
+    rmtree(cache,ignore_errors=True)
+    rmtree(parquet,ignore_errors=True)
+
+    if exists(filename):
+        remove(filename)
+
+    for vintage in range(vintages):
+        server.vintage=join(folder,"v%d" % vintage)
+        result=run(url,section,database,cache,options)
+
+        if result['status']!=0:
+            failures.append("vintage %d failed with status %d: %s" % (vintage,result['status']," ".join(result['command'])))
+
+        elif vintage>0 and '--delta' in options and len(result['deltas'])==0:
+            failures.append("vintage %d fell back to a full load" % vintage)
+
+    if len(failures)==0:
+        rows=history(database,section)
+
+        if rows['revised']==0:
+            failures.append("no value has more than one vintage in the history")
+
+        status=call([executable,join(dirname(FETCH),'export.py'),"--database",database,"--folder",parquet],stdout=DEVNULL,stderr=STDOUT)
+
+        if status!=0:
+            failures.append("export failed with status %d" % status)
+
+        series_id="%sUR0000SX0000" % section.upper() # the first series generated
+        dates,values=Reader(parse(database,True)).read_series([series_id])[series_id]
+
+        if len(dates)==0:
+            failures.append("no values read back for %s" % series_id)
+
+    return failures
+
+def main():
+    # arguments
+    from argparse import ArgumentParser
+    args=ArgumentParser();
+    args.add_argument("-f","--folder",type=str,default=join(getcwd(),"smoke"),help="Folder for the synthetic files and databases.")
+    args.add_argument("-S","--section",type=str,default='cu',help="Section the synthetic files imitate (must use the cu layout).")
+    args.add_argument("-b","--backend",type=str,action='append',default=None,help="Embedded backend to test, sqlite or duckdb (defaults to both).")
+    args.add_argument("-p","--port",type=int,default=8643,help="Port for the local HTTP server.")
+    args.add_argument("options",nargs='*',help="Further options for fetch.py, after -- (defaults to --delta).")
+    args=args.parse_args();
+
+    # initialize
+    print(__doc__,"\nParameters:",vars(args))
+    generate(args.folder,args.section,20,3,2,0.2,3,1)
+    server,status=serve(join(args.folder,"v0"),args.port),0
+
+    # main code
+    try:
+        for kind in args.backend or ['sqlite','duckdb']:
+            failures=check(server,kind,args.folder,args.section,3,args.options or ['--delta'])
+            print("Backend %s: %s." % (kind,"; ".join(failures) if failures else "passed"))
+            status=status or len(failures)
+
+    finally:
+        server.shutdown()
+
+    # done
+    print("Done.")
+    return 1 if status else 0
+
+# bootstrap
+if __name__ == "__main__":
+    assert(version_info.major>=3)
+    exit(main())
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Storage backends: a MySQL server through pymysql, or an embedded SQLite or DuckDB database file.
+
+An embedded database is chosen by giving its file in the --database string, as `sqlite=path` or `duckdb=path`."""
+
+# modules
+from pymysql import connect as mysql_connect
+from pymysql.cursors import DictCursor
+from sqlite3 import connect as sqlite_connect
+from hashlib import md5
+from os import getenv
+
+EMBEDDED=['sqlite','duckdb']
+
+# schema of the embedded databases, by table: columns besides id, timestamp and captured, then the unique key
+TABLES={
+    'BLSItems':(
+        [
+            ('section','varchar(2)'),
+            ('parent_id','bigint'),
+            ('children','integer default 0'),
+            ('item_code','varchar(16) not null'),
+            ('item_name','varchar(256)'),
+            ('display_level','integer'),
+            ('selectable','integer'),
+            ('sort_sequence','integer'),
+        ],
+        ['section','item_code']
+    ),
+    'BLSSeries':(
+        [
+            ('section','varchar(2)'),
+            ('series_id','varchar(32) not null'),
+            ('area_code','varchar(16)'),
+            ('item_code','varchar(16)'),
+            ('seasonal','varchar(1)'),
+            ('periodicity_code','varchar(1)'),
+            ('base_code','varchar(1)'),
+            ('base_period','varchar(20)'),
+            ('series_title','text'),
+            ('footnote_codes','varchar(16)'),
+            ('begin_year','integer'),
+            ('begin_period','varchar(3)'),
+            ('end_year','integer'),
+            ('end_period','varchar(3)'),
+            ('begin_date','date'),
+            ('end_date','date'),
+        ],
+        ['series_id']
+    ),
+    'BLSTimeSeries':(
+        [
+            ('series_id','varchar(32) not null'),
+            ('date','date'),
+            ('year','integer'),
+            ('period','varchar(3)'),
+            ('value','decimal(15,3)'),
+            ('footnote_codes','varchar(16)'),
+        ],
+        ['series_id','date']
+    ),
+    'BLSTimeSeriesHistory':(
+        [
+            ('seq','integer not null default 1'),
+            ('series_id','varchar(32) not null'),
+            ('date','date'),
+            ('year','integer'),
+            ('period','varchar(3)'),
+            ('value','decimal(15,3)'),
+            ('footnote_codes','varchar(16)'),
+            ('valid_to','timestamp'), # captured time of the revision that superseded this value, NULL while current
+        ],
+        ['series_id','date','value']
+    ),
+    'BLSLoads':(
+        [
+            ('sections','varchar(256)'),
+        ],
+        ['id']
+    ),
+    'BLSFiles':(
+        [
+            ('url','varchar(256) not null'),
+            ('sha256','char(64)'),
+        ],
+        ['url']
+    ),
+    'CPICategories':(
+        [
+            ('parent_id','bigint'),
+            ('children','integer not null default 0'),
+            ('Year','integer not null'),
+            ('IndexName','varchar(16) not null'),
+            ('Code','varchar(16)'),
+            ('Level','integer'),
+            ('Category','varchar(256) not null'),
+            ('Weight','double not null'),
+            ('Path','varchar(1024)'),
+            ('md5','char(32)'), # a generated column in MySQL, written by the scripts here
+        ],
+        ['md5']
+    ),
+}
+
+class Cursor:
+    """Cursor of an embedded database returning rows as dicts, like pymysql's DictCursor."""
+    def __init__(self,connection,cursor):
+        self.connection,self.cursor=connection,cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.cursor.close()
+
+    @property
+    def lastrowid(self):
+        return getattr(self.cursor,'lastrowid',None) # SQLite has it, DuckDB does not
+
+    def execute(self,sql,params=None):
+        self.cursor.execute(sql,params or ())
+        return self.cursor.rowcount
+
+    def executemany(self,sql,rows):
+        self.cursor.executemany(sql,rows)
+        return self.cursor.rowcount
+
+    def fetchall(self):
+        names=[column[0] for column in self.cursor.description or []]
+        return [dict(zip(names,row)) for row in self.cursor.fetchall()]
+
+    def fetchone(self):
+        names,row=[column[0] for column in self.cursor.description or []],self.cursor.fetchone()
+        return None if row==None else dict(zip(names,row))
+
+class Embedded:
+    """Connection to an embedded database file, with the parts of pymysql's connection interface the scripts use."""
+    def __init__(self,kind,path):
+        self.kind,self.path=kind,path
+
+        if kind=='sqlite':
+            self.connection=sqlite_connect(path,isolation_level=None,check_same_thread=False) # autocommit, as the MySQL connections are
+            self.connection.create_function('md5',1,lambda x:None if x==None else md5(x.encode()).hexdigest(),deterministic=True)
+
+        else:
+            from duckdb import connect # optional, only needed for DuckDB files
+            self.connection=connect(path)
+
+    def cursor(self):
+        return Cursor(self,self.connection.cursor())
+
+    def ping(self,reconnect=False):
+        pass
+
+    def close(self):
+        self.connection.close()
+
+def embedded(database):
+    """Whether a parsed --database string names an embedded database."""
+    return any(map(lambda x:x in database,EMBEDDED))
+
+def connect(database,**options):
+    """Connect to the database named by a parsed --database string."""
+    for kind in EMBEDDED:
+        if kind in database:
+            return Embedded(kind,database[kind])
+
+    return mysql_connect(
+        db=database['database'] if 'database' in database else 'mysql',
+        host=database['server'] if 'server' in database else 'localhost',
+        port=int(database['port']) if 'port' in database else 3306,
+        user=database['uid'] if 'uid' in database else getenv('USER'),
+        password=database['pwd'],
+        cursorclass=DictCursor,
+        autocommit=True,
+        **options
+    )
+
+def create(cursor,tables,update=True):
+    """Create tables in an embedded database if needed, adding any columns missing from existing ones. Returns the
+    columns added, as (table, column)."""
+    added=[]
+
+    for table in tables:
+        columns,key=TABLES[table]
+
+        if cursor.connection.kind=='sqlite':
+            identity=["id integer primary key autoincrement"]
+
+        else:
+            identity,sql=["id bigint primary key default nextval('%s_id')" % table],"CREATE SEQUENCE IF NOT EXISTS %s_id" % table
+            cursor.execute(sql) if update else print(sql)
+
+        sql="CREATE TABLE IF NOT EXISTS %s\n(\n    %s\n)" % (table,",\n    ".join(
+            identity+
+            ["timestamp timestamp default current_timestamp","captured timestamp default current_timestamp"]+
+            ["%s %s" % column for column in columns]+
+            ["unique (%s)" % ",".join(key)]
+        ))
+        print("Creating %s table if needed." % table)
+        cursor.execute(sql) if update else print(sql)
+
+        if update: # tables created before a column was added to the schema
+            cursor.execute("SELECT * FROM %s LIMIT 0" % table)
+            present=[column[0].lower() for column in cursor.cursor.description]
+
+            for column in filter(lambda x:x[0].lower() not in present,columns):
+                print("Adding column %s to %s table." % (column[0],table))
+                cursor.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table,*column))
+                added.append((table,column[0]))
+
+    return added
+
+def conflict(table,columns,replace=True,kind='sqlite'):
+    """ON CONFLICT clause of an embedded upsert, updating the columns given unless told to leave existing rows alone."""
+    key=TABLES[table][1]
+    updates=["%s=excluded.%s" % (column,column) for column in columns if column not in key]
+
+    if not replace or len(updates)==0:
+        return "ON CONFLICT (%s) DO NOTHING" % ",".join(key)
+
+    now="now()" if kind=='duckdb' else "current_timestamp" # DuckDB binds current_timestamp here to a column
+    return "ON CONFLICT (%s) DO UPDATE SET %s" % (",".join(key),",".join(updates+["timestamp=%s" % now])) # as MySQL's on update
+
+def upsert(connection,table,fields,replace=True):
+    """Statement inserting a row given as SQL literals, updating (or with replace false ignoring) any existing row."""
+    if isinstance(connection,Embedded):
+        return "INSERT INTO %s (%s) VALUES (%s) %s" % (table,",".join(fields.keys()),",".join(fields.values()),conflict(table,fields.keys(),replace,connection.kind))
+
+    if not replace:
+        return "INSERT IGNORE INTO %s (%s) VALUES (%s)" % (table,",".join(fields.keys()),",".join(fields.values()))
+
+    return "INSERT INTO %s (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (
+        table,
+        ",".join(fields.keys()),
+        ",".join(fields.values()),
+        ",".join(map(lambda x:"%s=%s" % x,fields.items()))
+    )
+
+def placeholder(connection):
+    """Parameter placeholder of a connection's driver."""
+    return '?' if isinstance(connection,Embedded) else '%s'
+
+def transaction(connection):
+    """Statement starting a transaction on a connection, which otherwise autocommits."""
+    return "BEGIN" if isinstance(connection,Embedded) else "START TRANSACTION"
+
+def upsert_many(connection,table,columns,rows,replace=True):
+    """Statement and parameters inserting several rows, given as tuples of values in the order of the columns, in one
+    statement, updating (or with replace false ignoring) any existing rows."""
+    values=",".join(["(%s)" % ",".join([placeholder(connection)]*len(columns))]*len(rows))
+    params=[value for row in rows for value in row]
+
+    if isinstance(connection,Embedded):
+        return "INSERT INTO %s (%s) VALUES %s %s" % (table,",".join(columns),values,conflict(table,columns,replace,connection.kind)),params
+
+    if not replace:
+        return "INSERT IGNORE INTO %s (%s) VALUES %s" % (table,",".join(columns),values),params
+
+    return "INSERT INTO %s (%s) VALUES %s ON DUPLICATE KEY UPDATE %s" % (
+        table,
+        ",".join(columns),
+        values,
+        ",".join(map(lambda x:"%s=VALUES(%s)" % (x,x),columns))
+    ),params
+
+def close_intervals(connection,since):
+    """Statement closing the validity interval of every current history row superseded by a history row with an id above
+    a watermark, setting its valid_to to the time the next revision was captured. A row is then the value as of any time
+    from its captured (inclusive) to its valid_to (exclusive, or open while NULL)."""
+    if isinstance(connection,Embedded): # no multi-table UPDATE in SQLite or DuckDB
+        return """/* CLOSE BLSTimeSeriesHistory INTERVALS */
+UPDATE
+    BLSTimeSeriesHistory
+SET
+    valid_to=(
+        SELECT MIN(new.captured)
+        FROM BLSTimeSeriesHistory AS new
+        WHERE new.series_id=BLSTimeSeriesHistory.series_id AND new.date=BLSTimeSeriesHistory.date AND new.id>BLSTimeSeriesHistory.id
+    )
+WHERE
+    valid_to IS NULL
+    AND id IN (
+        SELECT old.id
+        FROM BLSTimeSeriesHistory AS old JOIN BLSTimeSeriesHistory AS new ON new.series_id=old.series_id AND new.date=old.date AND new.id>old.id
+        WHERE new.id>%d
+    )""" % since
+
+    return """/* CLOSE BLSTimeSeriesHistory INTERVALS */
+UPDATE
+    BLSTimeSeriesHistory
+    JOIN (
+        SELECT old.id,MIN(new.captured) AS valid_to
+        FROM BLSTimeSeriesHistory AS old JOIN BLSTimeSeriesHistory AS new ON new.series_id=old.series_id AND new.date=old.date AND new.id>old.id
+        WHERE new.id>%d AND old.valid_to IS NULL
+        GROUP BY old.id
+    ) AS superseded USING (id)
+SET
+    BLSTimeSeriesHistory.valid_to=superseded.valid_to""" % since # grouped, so MySQL materializes it rather than reading the table it updates
+
+class Writer:
+    """Rows collected by table and written as multi-row parameterized upserts, up to batch rows a statement, in one
+    transaction. Tables are written in the order rows were first added to them, so add rows in foreign key order; rows
+    of a table with different columns go in separate statements. Other statements queued with execute() follow."""
+    def __init__(self,connection,batch=1000):
+        self.connection,self.batch,self.tables,self.rows,self.statements=connection,batch,[],{},[]
+
+    def add(self,table,fields,replace=True):
+        if table not in self.tables:
+            self.tables.append(table)
+
+        self.rows.setdefault((table,tuple(fields.keys()),replace),[]).append(tuple(fields.values()))
+
+    def execute(self,sql,params=None):
+        self.statements.append((sql,params))
+
+    def write(self,execute):
+        """Write everything collected with a function executing a statement with parameters, returning the statements
+        executed, and empty the writer. Nothing is written if any statement fails."""
+        statements=[
+            upsert_many(self.connection,table,columns,rows[n:n+self.batch],replace)
+            for (table,columns,replace),rows in sorted(self.rows.items(),key=lambda x:self.tables.index(x[0][0]))
+            for n in range(0,len(rows),self.batch)
+        ]+self.statements
+        execute(transaction(self.connection),None)
+
+        try:
+            for sql,params in statements:
+                execute(sql,params)
+
+            execute("COMMIT",None)
+
+        except:
+            execute("ROLLBACK",None)
+            raise
+
+        self.tables,self.rows,self.statements=[],{},[]
+        return len(statements)
+
+def bulk_load(cursor,table,columns,filename,replace=True,update=True,batch=10000):
+    """Bulk import a clean tab separated file, with \\N for NULL, into a table of an embedded database using its native
+    path: DuckDB's CSV reader, or batches of executemany for SQLite. Existing rows are replaced or, if not, kept."""
+    types=dict(TABLES[table][0])
+
+    if cursor.connection.kind=='duckdb':
+        sql="INSERT INTO %s (%s) SELECT * FROM read_csv('%s',delim='\\t',header=false,quote='',escape='',nullstr='\\N',columns={%s}) %s" % (
+            table,
+            ",".join(columns),
+            filename.replace("'","''"),
+            ",".join(map(lambda x:"'%s':'%s'" % (x,types[x].split()[0].upper()),columns)),
+            conflict(table,columns,replace,'duckdb')
+        )
+        return cursor.execute(sql) if update else print(sql)
+
+    sql="INSERT INTO %s (%s) VALUES (%s) %s" % (table,",".join(columns),",".join('?'*len(columns)),conflict(table,columns,replace,cursor.connection.kind))
+
+    if not update:
+        return print(sql)
+
+    with open(filename,newline='',encoding='latin-1') as cleanfile:
+        cursor.execute("BEGIN")
+
+        try:
+            rows,count=[],0
+
+            for line in cleanfile:
+                rows.append([None if field=='\\N' else field for field in line.rstrip('\n').split('\t')])
+
+                if len(rows)==batch:
+                    cursor.executemany(sql,rows)
+                    rows,count=[],count+len(rows)
+
+            cursor.executemany(sql,rows)
+            cursor.execute("COMMIT")
+            return count+len(rows)
+
+        except:
+            cursor.execute("ROLLBACK")
+            raise
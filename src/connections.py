@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Connections shared by the scripts: the --database string, a pool of database connections, and one HTTP session that
+retries with backoff and downloads several URLs at once.
+
+Run standalone, a script closes its connections when done. Under runner.py the pool keeps them instead, so the steps of
+a job reuse the same database connections and the same TLS connections to the BLS."""
+
+# modules
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from os.path import abspath
+from backends import connect as open_database,embedded,EMBEDDED
+
+def parse(string,hidden=False):
+    """Parse an ODBC style --database string, e.g. 'database=Analysis;server=db;uid=me', into a dict, taking a MySQL
+    password from $MYSQLPASSWORD or else prompting for it."""
+    database=dict(map(lambda x:x.split('=',1),string.split(';')))
+
+    if not embedded(database) and ('pwd' not in database or database['pwd']=='' or database['pwd']==None):
+        database['pwd']=getenv('MYSQLPASSWORD')
+
+    if not embedded(database) and (database['pwd']==None or database['pwd']==''):
+        from getpass import getpass
+        database['pwd']=getpass('Database password:')
+
+    if 'server' not in database or database['server']=='' or database['server']==None:
+        database['server']=database.get('sqlite') or database.get('duckdb') or 'localhost'
+
+    print("Connecting to database %s." % (database['server'] if not hidden else 'hidden'))
+    return database
+
+def identity(database):
+    """Name of the database a --database string, parsed or not, points at whatever the credentials: server, port and
+    database for MySQL, or the kind and file of an embedded database. State kept about a database outside it, such as
+    fetch.py's cache, is kept under this."""
+    for kind in EMBEDDED:
+        if kind in database:
+            return "%s:%s" % (kind,abspath(database[kind])) # the same file whatever folder a script is run from
+
+    return "mysql://%s:%s/%s" % (database.get('server') or 'localhost',database.get('port') or 3306,database.get('database') or 'mysql')
+
+class Pool:
+    """Idle database connections by connection string and options. Connections released while the pool is keeping them
+    are handed out again, checked with a ping first, rather than closed."""
+    def __init__(self):
+        self.idle,self.lock,self.keep=[],Lock(),False
+
+    def key(self,database,options):
+        return tuple(sorted(database.items())),tuple(sorted(options.items()))
+
+    def connect(self,database,**options):
+        key=self.key(database,options)
+
+        with self.lock:
+            for n,(k,connection) in enumerate(self.idle):
+                if k==key:
+                    del self.idle[n]
+                    break
+
+            else:
+                connection=None
+
+        if connection!=None:
+            try:
+                connection.ping(reconnect=True) # the server may have dropped it while idle
+                return connection
+
+            except Exception:
+                pass
+
+        return open_database(database,**options)
+
+    def release(self,database,connection,**options):
+        if not self.keep:
+            return connection.close()
+
+        with self.lock:
+            self.idle.append((self.key(database,options),connection))
+
+    def close(self):
+        with self.lock:
+            idle,self.idle=self.idle,[]
+
+        for key,connection in idle:
+            connection.close()
+
+pool=Pool()
+
+def connect(database,**options):
+    """Connection for a parsed --database string, from the pool if it has one."""
+    return pool.connect(database,**options)
+
+def release(database,connection,**options):
+    """Give a connection back: closed, or kept for the next step if the pool is keeping connections."""
+    pool.release(database,connection,**options)
+
+# retries of every request made through the session: on connection errors and on 429 and 5xx responses, at once, then
+# after 2, 4, 8 and 16 seconds or as long as a Retry-After header asks, returning the last response if they all fail
+RETRY=Retry(
+    total=5,
+    backoff_factor=1,
+    status_forcelist=[429,500,502,503,504],
+    allowed_methods=['GET','HEAD'],
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+http=None
+http_lock=Lock()
+
+def session():
+    """HTTP session shared by every download of the process, so connections to a server are kept alive and reused, with
+    failed requests retried."""
+    global http
+
+    with http_lock:
+        if http==None:
+            http=Session()
+            http.mount('https://',HTTPAdapter(pool_maxsize=32,max_retries=RETRY)) # as many as fetch.py downloads at once
+            http.mount('http://',HTTPAdapter(pool_maxsize=32,max_retries=RETRY))
+
+        return http
+
+def fetch_all(urls,jobs=8,method='GET',**options):
+    """Yield the responses to requests (GETs unless told otherwise) of several URLs, in order, making at most jobs of
+    them at once over the shared session's kept-alive connections. Options are those of requests, by URL if a function."""
+    with ThreadPoolExecutor(max_workers=jobs) as downloads:
+        yield from downloads.map(lambda url:session().request(method,url,**{k:v(url) if callable(v) else v for k,v in options.items()}),urls)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Script to export BLSTimeSeries, BLSSeries and BLSItems to Parquet files partitioned by section and year."""
+
+# modules
+from pymysql import DatabaseError,OperationalError
+from sys import stderr,stdout,version_info,exit
+from os import getenv,makedirs,replace
+from os.path import join,exists
+from json import load,dump
+from time import time
+from pymysql.cursors import SSCursor
+from pyarrow import array,table,schema,string,int32,int64,float64,date32,bool_
+from pyarrow.parquet import ParquetWriter
+from backends import Embedded
+from connections import parse,connect,release
+
+# columns exported from each table, with their Arrow types; rows are sorted by the last item
+TABLES={
+    'items':('BLSItems',[
+        ('id',int64()),
+        ('section',string()),
+        ('parent_id',int64()),
+        ('children',int32()),
+        ('item_code',string()),
+        ('item_name',string()),
+        ('display_level',int32()),
+        ('selectable',bool_()),
+        ('sort_sequence',int32()),
+    ],'item_code'),
+    'series':('BLSSeries',[
+        ('section',string()),
+        ('series_id',string()),
+        ('area_code',string()),
+        ('item_code',string()),
+        ('seasonal',string()),
+        ('periodicity_code',string()),
+        ('base_code',string()),
+        ('base_period',string()),
+        ('series_title',string()),
+        ('footnote_codes',string()),
+        ('begin_year',int32()),
+        ('begin_period',string()),
+        ('end_year',int32()),
+        ('end_period',string()),
+        ('begin_date',date32()),
+        ('end_date',date32()),
+    ],'series_id'),
+    'timeseries':('BLSTimeSeries',[
+        ('series_id',string()),
+        ('date',date32()),
+        ('year',int32()),
+        ('period',string()),
+        ('value',float64()),
+        ('footnote_codes',string()),
+    ],'series_id,date'),
+}
+
+def column(values,type):
+    """Arrow array for a column of database values, which differ in Python type between backends."""
+    if type==date32(): # dates come back as date objects from MySQL and as ISO strings from SQLite
+        return array([None if value==None else str(value) for value in values],type=string()).cast(type)
+
+    if type==float64(): # decimals from MySQL
+        return array([None if value==None else float(value) for value in values],type=type)
+
+    if type==bool_(): # a bit column reads as bytes from MySQL
+        return array([None if value==None else bool(ord(value) if isinstance(value,bytes) else value) for value in values],type=type)
+
+    return array(values,type=type)
+
+def partition(connection,args,kind,section,year=None):
+    """Write one partition of a table to its Parquet file, sorted, replacing the file atomically; returns the row count.
+
+    Rows are streamed over an unbuffered cursor and written a row group at a time, so only one row group is ever held in
+    memory. Files are laid out Hive style, as <kind>/section=<section>/year=<year>/part.parquet, so readers can prune
+    partitions."""
+    name,columns,order=TABLES[kind]
+    sql="SELECT %s FROM %s%s WHERE %s ORDER BY %s" % (
+        ",".join(map(lambda x:"%s.%s" % (name,x[0]),columns)),
+        name,
+        " JOIN BLSSeries ON BLSSeries.series_id=BLSTimeSeries.series_id" if kind=='timeseries' else '',
+        "BLSSeries.section='%s' AND BLSTimeSeries.year=%d" % (section,year) if kind=='timeseries' else "section='%s'" % section,
+        ",".join(map(lambda x:"%s.%s" % (name,x),order.split(',')))
+    )
+    folder=join(args.folder,kind,"section=%s" % section,*(["year=%d" % year] if year!=None else []))
+    columns=[(n,c,type) for n,(c,type) in enumerate(columns) if c not in ['section','year']] # partition keys are in the path, not the file
+    layout=schema([(c,type) for n,c,type in columns])
+    makedirs(folder,exist_ok=True)
+    cursor,count=connection.connection.cursor() if isinstance(connection,Embedded) else connection.cursor(SSCursor),0
+
+    try:
+        cursor.execute(sql)
+
+        with ParquetWriter(join(folder,"part.parquet.tmp"),layout,compression=args.compression,write_statistics=True) as writer:
+            while True:
+                rows=cursor.fetchmany(args.rowgroup) # tuples, in the order of the columns selected
+
+                if len(rows)==0:
+                    break
+
+                writer.write_table(table([column([row[n] for row in rows],type) for n,c,type in columns],schema=layout))
+                count+=len(rows)
+
+    finally:
+        cursor.close()
+
+    replace(join(folder,"part.parquet.tmp"),join(folder,"part.parquet")) # atomic, so readers never see a torn file
+    return count
+
+def main(argv=None):
+    # arguments
+    from argparse import ArgumentParser
+    args=ArgumentParser();
+    args.add_argument("-D","--database",type=str,default="database=Analysis",help='Database connection.')
+    args.add_argument("-H","--hidden",action='store_true',help="Prevent arguments and secrets being echoed to the terminal.")
+    args.add_argument("section",type=str,nargs='*',help="Sections to export (defaults to every section in the database).")
+    args.add_argument("-o","--folder",type=str,default="%s/Dropbox/Data/BLS/parquet" % getenv("HOME"),help="Folder for the Parquet files.")
+    args.add_argument("-F","--full",action='store_true',help="Set to rewrite every partition, not only those changed since the last export.")
+    args.add_argument("-g","--rowgroup",type=int,default=1<<16,help="Rows per Parquet row group.")
+    args.add_argument("-c","--compression",type=str,default='zstd',help="Parquet compression codec.")
+    args=args.parse_args(argv);
+
+    # initialize
+    print(__doc__,"\nParameters:",vars(args) if not args.hidden else 'hidden')
+
+    # connect to database
+    database=parse(args.database,args.hidden)
+    connection=connect(database)
+    makedirs(args.folder,exist_ok=True)
+    statefile=join(args.folder,"export.json")
+
+    # main code
+    sql=None
+
+    try:
+        with connection.cursor() as cursor:
+            # rows written after the last export started belong to partitions that need rewriting
+            sql="SELECT CAST(CURRENT_TIMESTAMP AS TIMESTAMP) AS now" if isinstance(connection,Embedded) and connection.kind=='duckdb' else "SELECT CURRENT_TIMESTAMP AS now" # a TIMESTAMPTZ would need pytz to fetch
+            cursor.execute(sql)
+            now=str(cursor.fetchone()['now'])
+            since=None
+
+            if exists(statefile) and not args.full:
+                with open(statefile) as state:
+                    since=load(state)['since']
+
+            print("Exporting rows changed since %s." % since if since!=None else "Exporting every row.")
+            changed=lambda x:"%s.timestamp>='%s'" % (x,since) if since!=None else "1=1"
+            selected=lambda x:"%s.section IN (%s)" % (x,",".join(map(lambda y:"'%s'" % y,args.section))) if len(args.section)>0 else "1=1"
+
+            sql="SELECT DISTINCT section FROM BLSItems WHERE %s AND %s UNION SELECT DISTINCT section FROM BLSSeries WHERE %s AND %s" % (
+                changed('BLSItems'),
+                selected('BLSItems'),
+                changed('BLSSeries'),
+                selected('BLSSeries')
+            )
+            cursor.execute(sql)
+            sections=sorted(row['section'] for row in cursor.fetchall())
+
+            sql="SELECT DISTINCT BLSSeries.section AS section,BLSTimeSeries.year AS year FROM BLSTimeSeries JOIN BLSSeries ON BLSSeries.series_id=BLSTimeSeries.series_id WHERE %s AND %s AND BLSTimeSeries.year IS NOT NULL" % (
+                changed('BLSTimeSeries'),
+                selected('BLSSeries')
+            )
+            cursor.execute(sql)
+            partitions=sorted((row['section'],int(row['year'])) for row in cursor.fetchall())
+            print("Found %d metadata and %d time series partitions to write." % (2*len(sections),len(partitions)))
+
+            for section in sections:
+                for kind in ['items','series']:
+                    started=time()
+                    count=partition(connection,args,kind,section)
+                    print("Wrote %d rows of %s for section '%s' in %.2fs." % (count,kind,section,time()-started))
+
+            for section,year in partitions:
+                started=time()
+                count=partition(connection,args,'timeseries',section,year)
+                print("Wrote %d rows of time series for section '%s' in %d in %.2fs." % (count,section,year,time()-started))
+
+            # only once every partition is written, so a failed export is redone from the same point
+            with open(statefile+".tmp","w") as state:
+                dump({'since':now},state)
+
+            replace(statefile+".tmp",statefile)
+
+    except (DatabaseError,OperationalError) as e:
+        stdout.flush()
+        stderr.write("Problem with SQL:\n%s\n%s\n" % (sql,str(e)))
+        raise
+
+    except KeyboardInterrupt:
+        stdout.flush()
+        stderr.write('Interrupted.\n')
+        return 1
+
+    finally:
+        release(database,connection)
+
+    # done
+    print("Done.")
+    return 0
+
+# bootstrap
+if __name__ == "__main__":
+    assert(version_info.major>=3)
+    exit(main())
@@ -3,98 +3,858 @@
 """Script to image a section of the BLS's LABSTAT database."""
 
 # modules
-from pymysql import connect,DatabaseError,Warning,OperationalError
-from pymysql.cursors import DictCursor
-from sys import stderr,stdout,version_info
-from os import getenv,chmod,unlink
-from requests import get
+from pymysql import DatabaseError,Warning,OperationalError
+from sys import stderr,stdout,version_info,platform,exit,exc_info
+from os import getenv,chmod,unlink,makedirs,replace
+from os.path import exists,getsize
+from shutil import copyfile
+from hashlib import sha256
+from json import load,dump
+from resource import getrusage,RUSAGE_SELF
 from tempfile import NamedTemporaryFile
+from time import time,sleep
+from threading import local,Lock
+from concurrent.futures import ThreadPoolExecutor,as_completed,wait
+from contextlib import contextmanager
+from normalize import normalize,COLUMNS
+from sections import SECTIONS,columns,filenames
+from backends import embedded,create,bulk_load,upsert,close_intervals,Embedded,Cursor
+from connections import parse,identity,connect,release,session
+from metrics import Metrics
 from warnings import filterwarnings
 filterwarnings("ignore", message="numpy.dtype size changed")
 filterwarnings("ignore", message="numpy.ufunc size changed")
 
-def main():
-    # arguments
-    from argparse import ArgumentParser
-    args=ArgumentParser();
-    args.add_argument("-D","--database",type=str,default="database=Analysis",help='Database connection.') 
-    args.add_argument("-T","--truncate",action='store_true',help="Drop tables.")
-    args.add_argument("-U","--update",action='store_true',help="Set to update database.")
-    args.add_argument("-H","--hidden",action='store_true',help="Prevent arguments and secrets being echoed to the terminal.")    
-    args.add_argument("section",type=str,choices=['ap','cu','su'],help="Section of LABSTAT to extract.")
-    args.add_argument("-u","--url",type=str,default='https://download.bls.gov/pub/time.series/%s',help="URL for data folder.")
-    args.add_argument("-n","--newline",type=str,default=r'\r\n',help="Line break code for data files.")
-    args.add_argument("-c","--column",type=str,default=r'\t',help="Column break code for data files.")
-    args.add_argument("-I","--ignore",type=int,default=1,help="Header lines to ignore in files.")
-    args.add_argument("-s","--series",type=str,default='%s.series',help="Name of data file for series metadata.")
-    args.add_argument("-d","--data",type=str,default='%s.data.0.Current',help="Name of data file for time series.")
-    args.add_argument("-k","--keep",action='store_false',help="Set to keep temporary files (usually for debugging).")
-    args.add_argument("-i","--items",type=str,default="%s.item",help="Name of data file for item metadata.")
-    args.add_argument("-w","--warnings",action='store_true',help="Set to catch database warnings.")
-    args.add_argument("-L","--local",action='store_true',help="Set to use LOAD DATA LOCAL INFILE rather than just LOAD DATA INFILE.")
-    args=args.parse_args();
-    
-    if "%s" in args.url:
-        args.url=args.url % args.section
-        
-    if "%s" in args.series:
-        args.series=args.series % args.section
+metrics=Metrics('fetch')
 
-    if "%s" in args.data:
-        args.data=args.data % args.section
-        
-    if "%s" in args.items:
-        args.items=args.items % args.section
+def peak_memory():
+    """Peak resident set size of this process in bytes."""
+    return getrusage(RUSAGE_SELF).ru_maxrss*(1 if platform=='darwin' else 1024) # macOS reports bytes, Linux kilobytes
 
-    # initialize
-    print(__doc__,"\nParameters:",vars(args) if not args.hidden else 'hidden')
+class DownloadCache:
+    """On-disk record, keyed by URL, of the validators and content hash of each file last loaded into one database, and
+    optionally an archive keeping a vintage of every file downloaded.
 
-    if not args.warnings:
-        filterwarnings('ignore',category=Warning)
-    
-    # connect to database
-    database=dict(map(lambda x:x.split('='),args.database.split(';')))
+    Entries, snapshots and manifests are kept in a folder of their own for each database (by its identity), and once
+    told what the database itself records as loaded (BLSFiles), an entry only counts while the database has that
+    content, so a new, emptied or restored database is loaded in full whatever the cache says."""
+    def __init__(self,folder,archive=None,database=None):
+        self.folder,self.archive,self.loaded=folder,archive,None
+
+        if database!=None:
+            self.folder="%s/%s" % (folder,sha256(database.encode()).hexdigest()[:16])
+
+        makedirs(self.folder,exist_ok=True)
+
+    def filename(self,url):
+        return "%s/%s.json" % (self.folder,sha256(url.encode()).hexdigest())
+
+    def get(self,url):
+        try:
+            with open(self.filename(url)) as cachefile:
+                entry=load(cachefile)
+
+        except (FileNotFoundError,ValueError):
+            return None
+
+        if self.loaded!=None and self.loaded.get(url)!=entry.get('sha256'): # not what the database has
+            return None
+
+        return entry
+
+    def put(self,url,entry):
+        with open(self.filename(url)+".tmp","w") as cachefile:
+            dump({k:v for k,v in entry.items() if k not in ['changed','status']},cachefile)
+
+        replace(self.filename(url)+".tmp",self.filename(url)) # atomic, so a crash never leaves a torn entry
+
+        if self.loaded!=None:
+            self.loaded[url]=entry['sha256']
+
+    def snapshot(self,url):
+        return "%s/%s.snapshot" % (self.folder,sha256(url.encode()).hexdigest())
+
+    def manifest(self,sections):
+        return "%s/manifest-%s.json" % (self.folder,"-".join(sorted(sections)))
+
+class Manifest:
+    """Progress of a run, saved after every step so that --resume can carry on from the first step not done: for each
+    file its download (cache entry and path) and the load steps done, for each section whether it has loaded and whether
+    later stages must reload, and whether blank rows have been trimmed since."""
+    def __init__(self,filename,resume=False,update=True):
+        self.filename,self.update,self.lock,self.run=filename,update,Lock(),None
+
+        if resume:
+            try:
+                with open(filename) as manifestfile:
+                    self.run=load(manifestfile)
+
+            except (FileNotFoundError,ValueError):
+                pass
+
+        if self.run==None or self.run['complete']:
+            self.run={'files':{},'sections':{},'trimmed':False,'complete':False}
+
+        else:
+            print("Resuming the run recorded in %s." % filename)
+
+        self.save()
+
+    def save(self):
+        if self.update:
+            with open(self.filename+".tmp","w") as manifestfile:
+                dump(self.run,manifestfile)
+
+            replace(self.filename+".tmp",self.filename) # atomic, so a crash never leaves a torn manifest
+
+    def file(self,url):
+        with self.lock:
+            return dict(self.run['files'].get(url,{}))
+
+    def put(self,url,**fields):
+        with self.lock:
+            self.run['files'].setdefault(url,{'steps':[]}).update(fields)
+            self.save()
+
+    def step(self,url,step):
+        with self.lock:
+            self.run['files'].setdefault(url,{'steps':[]})['steps'].append(step)
+            self.save()
+
+    def section(self,section,state=None):
+        with self.lock:
+            if state!=None:
+                self.run['sections'][section]={'reload':state['reload'],'loaded':state['loaded']}
+                self.run['trimmed']=self.run['trimmed'] and not state['loaded']
+                self.save()
+
+            return self.run['sections'].get(section,{'reload':False,'loaded':False})
+
+    def trimmed(self,done=None):
+        with self.lock:
+            if done!=None:
+                self.run['trimmed']=done
+                self.save()
+
+            return self.run['trimmed']
+
+    def complete(self):
+        with self.lock:
+            self.run['complete']=True
+            self.save()
+
+class Steps:
+    """Load steps done for one file, as recorded in the run manifest."""
+    def __init__(self,manifest,url):
+        self.manifest,self.url=manifest,url
+
+    def __contains__(self,step):
+        return step in self.manifest.file(self.url).get('steps',[])
+
+    def add(self,step):
+        if step not in self:
+            self.manifest.step(self.url,step)
+
+def download(url,tempfile,chunksize=1<<20,cached=None):
+    """Stream a URL into an open binary file chunk by chunk, so memory use is bounded by the chunk size.
+
+    If a cache entry is given the request is conditional, and the returned entry is flagged unchanged when the server
+    answers 304 or the content hash matches the one previously loaded."""
+    headers={'Accept-Encoding':'gzip, deflate'} # transfer compressed, iter_content() decodes
+
+    if cached!=None:
+        if cached.get('etag'):
+            headers['If-None-Match']=cached['etag']
+
+        if cached.get('last_modified'):
+            headers['If-Modified-Since']=cached['last_modified']
+
+    response=session().get(url,stream=True,headers=headers)
+
+    with response:
+        if response.status_code==304 and cached!=None:
+            print("Not modified since %s: %s" % (cached.get('last_modified') or cached.get('etag'),url))
+            return dict(cached,changed=False,status=304)
+
+        if response.status_code//100!=2:
+            raise ValueError("Status code %d returned for URL %s" % (response.status_code,url))
+
+        size,digest=0,sha256()
+
+        for chunk in response.iter_content(chunk_size=chunksize):
+            tempfile.write(chunk)
+            digest.update(chunk)
+            size+=len(chunk)
 
-    if 'pwd' not in database or database['pwd']=='' or database['pwd']==None:
-        database['pwd']=getenv('MYSQLPASSWORD')
+        entry={
+            'url':url,
+            'etag':response.headers.get('ETag'),
+            'last_modified':response.headers.get('Last-Modified'),
+            'sha256':digest.hexdigest(),
+            'size':size,
+            'status':response.status_code,
+        }
 
-    if database['pwd']==None or database['pwd']=='':
-        from getpass import getpass
-        database['pwd']=getpass('Database password:')
+    tempfile.flush()
+    chmod(tempfile.name,0o644) # change file permissions
+    print("Downloaded %d bytes from %s, peak memory %.1f MiB." % (size,url,peak_memory()/1048576.0))
+    entry['changed']=cached==None or cached.get('sha256')!=entry['sha256']
+    return entry
 
-    if 'server' not in database or database['server']=='' or database['server']==None:
-        database['server']='localhost'
+def separator(code):
+    """Character for a LOAD DATA style escape code such as '\\t'."""
+    return code.encode().decode('unicode_escape')
 
-    print("Connecting to database %s." % (database['server'] if not args.hidden else 'hidden'))
+def rows(args,filename):
+    """Yield the key, values and raw line of each row of a time series file, which must be sorted by key."""
+    with open(filename,newline='',encoding='latin-1') as datafile:
+        last=None
 
-    connection=connect(
-        db=database['database'] if 'database' in database else 'mysql',
-        host=database['server'] if 'server' in database else 'localhost',
-        port=int(database['port']) if 'port' in database else 3306,
-        user=database['uid'] if 'uid' in database else getenv('USER'),
-        password=database['pwd'],
-        cursorclass=DictCursor,
-        autocommit=True,
-        local_infile=True,
+        for n,line in enumerate(datafile):
+            fields=[field.strip() for field in line.split(separator(args.column))]
+
+            if n<args.ignore or len(fields)<3 or fields[0]=='': # headers and blank rows
+                continue
+
+            key=(fields[0],fields[1],fields[2]) # series_id, year, period
+
+            if last!=None and key<=last:
+                raise ValueError("File %s is not sorted by series, year and period at line %d." % (filename,n+1))
+
+            last=key
+            yield key,fields[3:],line
+
+def delta(args,previous,current,output):
+    """Merge two sorted time series files, writing the rows of the current one that are new or changed to output."""
+    counts,old,new={'inserted':0,'changed':0,'unchanged':0,'deleted':0},rows(args,previous),rows(args,current)
+
+    with open(current,newline='',encoding='latin-1') as datafile: # keep the headers so IGNORE n LINES still applies
+        for n in range(args.ignore):
+            output.write(datafile.readline())
+
+    a,b=next(old,None),next(new,None)
+
+    while b!=None:
+        if a==None or b[0]<a[0]:
+            output.write(b[2])
+            counts['inserted']+=1
+            b=next(new,None)
+
+        elif b[0]==a[0]:
+            if b[1]!=a[1]:
+                output.write(b[2])
+                counts['changed']+=1
+
+            else:
+                counts['unchanged']+=1
+
+            a,b=next(old,None),next(new,None)
+
+        else:
+            counts['deleted']+=1
+            a=next(old,None)
+
+    while a!=None:
+        counts['deleted']+=1
+        a=next(old,None)
+
+    output.flush()
+    chmod(output.name,0o644) # change file permissions
+    return counts
+
+def execute(cursor,args,sql):
+    """Execute a statement if updating, otherwise echo it."""
+    try:
+        if args.update:
+            metrics.execute(cursor,sql)
+
+        else:
+            print(sql)
+
+    except (DatabaseError,OperationalError) as e:
+        stdout.flush()
+        stderr.write("Problem with SQL:\n%s\n%s\n" % (sql,str(e)))
+        raise
+
+@contextmanager
+def normalized(args,kind,section,filename):
+    """Pre-normalize a raw file into a clean temporary file, yielding its name."""
+    with NamedTemporaryFile(dir='/tmp',delete=args.keep,mode='w+',newline='',encoding='latin-1') as cleanfile:
+        with metrics.timed('normalize',kind=kind) as entry:
+            count=entry['rows']=normalize(kind,section,filename,cleanfile,separator(args.column),args.ignore)
+
+        chmod(cleanfile.name,0o644) # change file permissions
+        print("Normalized %d rows of %s for LABSTAT section '%s'." % (count,kind,section))
+        yield cleanfile.name
+
+def load_clean(cursor,args,filename,kind,table,mode,extra=''):
+    """Bulk load a normalized file into a table with a plain column list."""
+    if isinstance(cursor,Cursor): # embedded databases import the file themselves, keeping existing history rows
+        with metrics.timed('sql',statement="LOAD %s DATA" % table) as entry:
+            rows=bulk_load(cursor,table,COLUMNS[kind],filename,mode=='REPLACE',args.update)
+            entry['rows']=rows if isinstance(rows,int) and rows>=0 else None # DuckDB may not know
+
+        return
+
+    sql="""/* LOAD %s DATA */
+LOAD DATA %s INFILE
+    '%s'
+%sINTO TABLE
+    %s
+FIELDS TERMINATED BY '\\t'
+LINES TERMINATED BY '\\n'
+(
+    %s
+)%s""" % (
+        table,
+        'LOCAL' if args.local else '',
+        filename,
+        mode+' ' if mode else '',
+        table,
+        ",\n    ".join(map(lambda x:'@'+x if x=='selectable' else x,COLUMNS[kind])), # text won't load into a bit column
+        "\nSET\n    "+",\n    ".join(filter(None,["selectable=CAST(@selectable AS UNSIGNED)" if kind=='items' else '',extra])) if kind=='items' or extra else ''
     )
+    execute(cursor,args,sql)
+
+# SQL expressions cleaning each raw column that is loaded, by kind of file
+EXPRESSIONS={
+    'items':{
+        'item_code':"TRIM(@item_code)",
+        'item_name':"TRIM(REGEXP_REPLACE(@item_name,'\\\\s+',' '))",
+        'display_level':"CASE WHEN LENGTH(TRIM(@display_level))>0 THEN @display_level+0 END",
+        'selectable':"CASE @selectable WHEN 'T' THEN 1 WHEN 'F' THEN 0 END",
+        'sort_sequence':"CASE WHEN LENGTH(TRIM(@sort_sequence))>0 THEN @sort_sequence+0 END",
+    },
+    'series':{
+        'series_id':"TRIM(@series_id)",
+        'area_code':"TRIM(@area_code)",
+        'item_code':"TRIM(@item_code)",
+        'seasonal':"CASE WHEN LENGTH(TRIM(@seasonal))>0 THEN TRIM(@seasonal) END",
+        'periodicity_code':"CASE WHEN LENGTH(TRIM(@periodicity_code))>0 THEN TRIM(@periodicity_code) END",
+        'base_code':"CASE WHEN LENGTH(TRIM(@base_code))>0 THEN TRIM(@base_code) END",
+        'base_period':"CASE WHEN LENGTH(TRIM(@base_period))>0 THEN TRIM(@base_period) END",
+        'series_title':"TRIM(@series_title)",
+        'footnote_codes':"CASE WHEN LENGTH(TRIM(@footnote_codes))>0 THEN TRIM(@footnote_codes) END",
+        'begin_year':"CASE WHEN LENGTH(TRIM(@begin_year))>0 THEN @begin_year+0 END",
+        'begin_period':"CASE WHEN LENGTH(TRIM(@begin_period))>0 THEN @begin_period END",
+        'end_year':"CASE WHEN LENGTH(TRIM(@end_year))>0 THEN @end_year+0 END",
+        'end_period':"CASE WHEN LENGTH(TRIM(@end_period))>0 THEN @end_period END",
+    },
+}
+
+# SQL expressions for series columns derived from the others, which must come after them
+DERIVED={
+    'begin_date':"""CASE
+                    WHEN begin_year>0 AND begin_period LIKE 'M%' AND begin_period<>'M13' THEN STR_TO_DATE(CONCAT(begin_year,begin_period,'01'),'%YM%m%d') 
+                    WHEN begin_year>0 AND begin_period='S01' THEN STR_TO_DATE(CONCAT(begin_year,'0101'),'%Y%m%d') 
+                    WHEN begin_year>0 AND begin_period='S02' THEN STR_TO_DATE(CONCAT(begin_year,'0701'),'%Y%m%d')
+                    WHEN begin_year>0 AND begin_period IN ('M13','S03') THEN STR_TO_DATE(CONCAT(begin_year,'0101'),'%Y%m%d') 
+                END""",
+    'end_date':"""CASE 
+                WHEN end_year>0 AND end_period LIKE 'M%' AND end_period<>'M13' THEN LAST_DAY(STR_TO_DATE(CONCAT(end_year,end_period,'01'),'%YM%m%d')) 
+                WHEN end_year>0 AND end_period='S01' THEN STR_TO_DATE(CONCAT(begin_year,'0630'),'%Y%m%d') 
+                WHEN end_year>0 AND end_period='S02' THEN STR_TO_DATE(CONCAT(begin_year,'1231'),'%Y%m%d') 
+                WHEN begin_year>0 AND begin_period IN ('M13','S03') THEN STR_TO_DATE(CONCAT(begin_year,'1231'),'%Y%m%d') 
+              END""",
+    'seasonal':"CASE WHEN series_title LIKE '%not seasonally adjusted%' THEN 'U' ELSE 'S' END", # when the file has no seasonal column
+}
+
+def merge(cursor,args,table,columns,load):
+    """Load metadata into a temporary table of the columns loaded, with a function given its name, then upsert it into
+    its table in one statement. Rows are updated in place rather than REPLACEd, which would delete them and cascade the
+    deletes down the foreign keys to the time series and their history."""
+    staging=table+"Staging"
+
+    for sql in [
+        "DROP TEMPORARY TABLE IF EXISTS %s" % staging, # the columns loaded depend on the section's layout
+        "CREATE TEMPORARY TABLE %s SELECT %s FROM %s LIMIT 0" % (staging,",".join(columns),table),
+    ]:
+        execute(cursor,args,sql)
+
+    load(staging)
+    sql="""/* MERGE %s DATA */
+INSERT INTO %s
+    (%s)
+SELECT
+    %s
+FROM
+    %s
+ON DUPLICATE KEY UPDATE
+    %s""" % (
+        table,
+        table,
+        ",".join(columns),
+        ",".join(columns),
+        staging,
+        ",\n    ".join(map(lambda x:"%s=VALUES(%s)" % (x,x),columns))
+    )
+    execute(cursor,args,sql)
+
+def load_metadata(cursor,args,section,filename,kind,table):
+    """Bulk load an items or series file into its table, with the column layout from the section registry, updating
+    existing rows in place."""
+    if args.normalize:
+        with normalized(args,kind,section,filename) as clean:
+            if isinstance(cursor,Cursor): # embedded databases upsert in place already
+                return load_clean(cursor,args,clean,kind,table,'REPLACE')
+
+            return merge(cursor,args,table,COLUMNS[kind],lambda staging:load_clean(cursor,args,clean,kind,staging,''))
+
+    names=columns(section,kind)
+    sets=["section='%s'" % section]+["%s=%s" % (name,EXPRESSIONS[kind][name]) for name in names if name in EXPRESSIONS[kind]]
+
+    if kind=='series':
+        sets+=["%s=%s" % (name,DERIVED[name]) for name in ['begin_date','end_date']]
+
+        if 'seasonal' not in names and 'series_title' in names:
+            sets.append("seasonal=%s" % DERIVED['seasonal'])
+
+    def load(staging):
+        sql="""/* LOAD %s DATA */
+LOAD DATA %s INFILE
+    '%s'
+INTO TABLE
+    %s
+FIELDS TERMINATED BY '%s'
+LINES TERMINATED BY '%s'
+IGNORE %d LINES
+(
+    %s
+)
+SET
+    %s""" % (
+            table,
+            'LOCAL' if args.local else '',
+            filename,
+            staging,
+            args.column,
+            args.newline,
+            args.ignore,
+            ",\n    ".join(map(lambda x:'@'+x,names)), # columns not in the table are read into unused variables
+            ",\n    ".join(sets)
+        )
+        execute(cursor,args,sql)
+
+    merge(cursor,args,table,[x.split('=',1)[0] for x in sets],load)
+
+def load_items(cursor,args,section,filename):
+    """Bulk load an items file into BLSItems."""
+    print("Bulk load of items metadata into database for LABSTAT section '%s'." % section)
+    load_metadata(cursor,args,section,filename,'items','BLSItems')
+
+def load_series(cursor,args,section,filename):
+    """Bulk load a series file into BLSSeries."""
+    print("Bulk load of series metadata into database for LABSTAT section '%s'." % section)
+    load_metadata(cursor,args,section,filename,'series','BLSSeries')
+
+def load_data(cursor,args,section,filename,chunkers=None,steps=None):
+    """Bulk load a time series file into BLSTimeSeries and BLSTimeSeriesHistory, in chunks if given chunk loaders.
+
+    Steps already done ('loaded' into BLSTimeSeries, 'history') are skipped, and each one is added as it completes."""
+    steps=set() if steps==None else steps
+
+    if chunkers!=None or args.staging: # in one go
+        if chunkers!=None:
+            load_chunks(chunkers,args,section,filename)
+
+        else:
+            load_staged(cursor,args,section,filename)
+
+        steps.add('loaded')
+        return steps.add('history')
+
+    if args.normalize:
+        with normalized(args,'data',section,filename) as clean:
+            if 'loaded' not in steps:
+                print("Bulk load of time series data into database for LABSTAT section '%s'." % section)
+                load_clean(cursor,args,clean,'data','BLSTimeSeries','REPLACE')
+                steps.add('loaded')
+
+            if 'history' not in steps:
+                print("Bulk load of time series data into history table in database for LABSTAT section '%s'." % section)
+                load_clean(cursor,args,clean,'data','BLSTimeSeriesHistory','IGNORE','seq=seq+1')
+                steps.add('history')
+
+            return
+
+    sql="""/* LOAD BLSTimeSeries DATA */
+LOAD DATA %s INFILE
+    '%s'
+REPLACE INTO TABLE
+    BLSTimeSeries
+FIELDS TERMINATED BY '%s'
+LINES TERMINATED BY '%s'
+IGNORE %d LINES
+(
+    @series_id,
+    @year,
+    @period,
+    @value,
+    @footnote_codes
+)
+SET
+    series_id=TRIM(@series_id),
+    year=CASE WHEN LENGTH(TRIM(@year))>0 THEN @year+0 END,
+    period=CASE WHEN LENGTH(TRIM(@period))>0 THEN @period END,
+    value=CASE WHEN LENGTH(TRIM(@value))>0 AND TRIM(@value)<>'-' THEN @value+0e0 END,
+    footnote_codes=CASE WHEN LENGTH(TRIM(@footnote_codes))>0 THEN TRIM(@footnote_codes) END,
+    date=CASE 
+             WHEN year>0 AND period LIKE 'M%%' AND period<>'M13' THEN LAST_DAY(STR_TO_DATE(CONCAT(year,period,'01'),'%%YM%%m%%d')) 
+             WHEN year>0 AND period='S01' THEN STR_TO_DATE(CONCAT(year,'0630'),'%%Y%%m%%d')
+             WHEN year>0 AND period IN ('M13','S02','S03') THEN STR_TO_DATE(CONCAT(year,'1231'),'%%Y%%m%%d')
+         END""" % (
+        'LOCAL' if args.local else '',
+        filename,
+        args.column,
+        args.newline,
+        args.ignore
+    )
+
+    if 'loaded' not in steps:
+        print("Bulk load of time series data into database for LABSTAT section '%s'." % section)
+        execute(cursor,args,sql)
+        steps.add('loaded')
+
+    sql="""/* LOAD BLSTimeSeriesHistory DATA */
+LOAD DATA %s INFILE
+    '%s'
+IGNORE INTO TABLE
+    BLSTimeSeriesHistory
+FIELDS TERMINATED BY '%s'
+LINES TERMINATED BY '%s'
+IGNORE %d LINES
+(
+    @series_id,
+    @year,
+    @period,
+    @value,
+    @footnote_codes
+)
+SET
+    series_id=TRIM(@series_id),
+    year=CASE WHEN LENGTH(TRIM(@year))>0 THEN @year+0 END,
+    period=CASE WHEN LENGTH(TRIM(@period))>0 THEN @period END,
+    value=CASE WHEN LENGTH(TRIM(@value))>0 AND TRIM(@value)<>'-' THEN @value+0e0 END,
+    footnote_codes=CASE WHEN LENGTH(TRIM(@footnote_codes))>0 THEN TRIM(@footnote_codes) END,
+    date=CASE 
+             WHEN year>0 AND period LIKE 'M%%' AND period<>'M13' THEN LAST_DAY(STR_TO_DATE(CONCAT(year,period,'01'),'%%YM%%m%%d')) 
+             WHEN year>0 AND period='S01' THEN STR_TO_DATE(CONCAT(year,'0630'),'%%Y%%m%%d')
+             WHEN year>0 AND period IN ('M13','S02','S03') THEN STR_TO_DATE(CONCAT(year,'1231'),'%%Y%%m%%d')
+         END,
+    seq=seq+1""" % (
+        'LOCAL' if args.local else '',
+        filename,
+        args.column,
+        args.newline,
+        args.ignore
+    )
+
+    if 'history' not in steps:
+        print("Bulk load of time series data into history table in database for LABSTAT section '%s'." % section)
+        execute(cursor,args,sql)
+        steps.add('history')
+
+def close_history(cursor,args,since):
+    """Close the validity interval of every current history row superseded by a history row with an id above a
+    watermark (see backends.close_intervals), in one statement."""
+    print("Closing superseded time series history from id %d." % since)
+    execute(cursor,args,close_intervals(cursor.connection,since))
+
+def history_since(cursor,args,manifest,url):
+    """Latest history id before a time series file is loaded, recorded in the run manifest so that a resumed run closes
+    the intervals superseded by rows the interrupted run already added."""
+    if 'since' not in manifest.file(url):
+        sql="SELECT MAX(id) AS id FROM BLSTimeSeriesHistory"
+        execute(cursor,args,sql)
+        manifest.put(url,since=(cursor.fetchone()['id'] or 0) if args.update else 0)
+
+    return manifest.file(url)['since']
+
+def open_connection(database):
+    """Open a connection from a parsed --database string, or reuse one the runner's pool kept."""
+    return connect(database,local_infile=True)
+
+def close_connection(database,connection):
+    """Close a connection opened by open_connection(), or keep it in the runner's pool."""
+    release(database,connection,local_infile=True)
+
+class Workers:
+    """Thread pool in which each worker thread holds its own database connection."""
+    def __init__(self,database,jobs):
+        self.database,self.local,self.lock,self.connections=database,local(),Lock(),[]
+        self.pool=ThreadPoolExecutor(max_workers=jobs)
+
+    def connection(self):
+        if not hasattr(self.local,'connection'):
+            self.local.connection=open_connection(self.database)
+
+            with self.lock:
+                self.connections.append(self.local.connection)
+
+        return self.local.connection
+
+    def submit(self,function,*args):
+        return self.pool.submit(lambda:function(self.connection(),*args))
+
+    def close(self):
+        self.pool.shutdown()
+
+        for connection in self.connections:
+            close_connection(self.database,connection)
+
+def load_staged(cursor,args,section,filename):
+    """Bulk load a time series file into an unindexed staging table, validate it, drop the rows the live table already
+    has, then merge the new and changed rows into BLSTimeSeries and BLSTimeSeriesHistory in one transaction, so the live
+    tables are only written for the rows that changed, for the length of the merge."""
+    print("Creating staging table for time series data if needed.")
+    sql="""/* CREATE BLSTimeSeriesStaging TABLE */
+CREATE TEMPORARY TABLE IF NOT EXISTS BLSTimeSeriesStaging
+(
+    series_id varchar(32),
+    date date,
+    year int,
+    period varchar(3),
+    value decimal(15,3),
+    footnote_codes varchar(16)
+)"""
+    execute(cursor,args,sql)
+    sql="TRUNCATE TABLE BLSTimeSeriesStaging"
+    execute(cursor,args,sql)
+
+    if args.normalize:
+        with normalized(args,'data',section,filename) as clean:
+            print("Bulk load of time series data into staging table for LABSTAT section '%s'." % section)
+            load_clean(cursor,args,clean,'data','BLSTimeSeriesStaging','')
+
+    else:
+        sql="""/* LOAD BLSTimeSeriesStaging DATA */
+LOAD DATA %s INFILE
+    '%s'
+INTO TABLE
+    BLSTimeSeriesStaging
+FIELDS TERMINATED BY '%s'
+LINES TERMINATED BY '%s'
+IGNORE %d LINES
+(
+    @series_id,
+    @year,
+    @period,
+    @value,
+    @footnote_codes
+)
+SET
+    series_id=TRIM(@series_id),
+    year=CASE WHEN LENGTH(TRIM(@year))>0 THEN @year+0 END,
+    period=CASE WHEN LENGTH(TRIM(@period))>0 THEN @period END,
+    value=CASE WHEN LENGTH(TRIM(@value))>0 AND TRIM(@value)<>'-' THEN @value+0e0 END,
+    footnote_codes=CASE WHEN LENGTH(TRIM(@footnote_codes))>0 THEN TRIM(@footnote_codes) END,
+    date=CASE 
+             WHEN year>0 AND period LIKE 'M%%' AND period<>'M13' THEN LAST_DAY(STR_TO_DATE(CONCAT(year,period,'01'),'%%YM%%m%%d')) 
+             WHEN year>0 AND period='S01' THEN STR_TO_DATE(CONCAT(year,'0630'),'%%Y%%m%%d')
+             WHEN year>0 AND period IN ('M13','S02','S03') THEN STR_TO_DATE(CONCAT(year,'1231'),'%%Y%%m%%d')
+         END""" % (
+            'LOCAL' if args.local else '',
+            filename,
+            args.column,
+            args.newline,
+            args.ignore
+        )
+
+        print("Bulk load of time series data into staging table for LABSTAT section '%s'." % section)
+        execute(cursor,args,sql)
+
+    # validate before touching the live tables
+    if not args.normalize: # normalization already dropped blank rows
+        sql=r"DELETE FROM BLSTimeSeriesStaging WHERE series_id NOT RLIKE '\\w'"
+        execute(cursor,args,sql)
+
+    sql="""/* VALIDATE BLSTimeSeriesStaging DATA */
+SELECT
+    COUNT(*) AS records,
+    SUM(date IS NULL) AS undated,
+    SUM(BLSSeries.id IS NULL) AS orphans
+FROM
+    BLSTimeSeriesStaging
+    LEFT JOIN BLSSeries USING (series_id)"""
+    execute(cursor,args,sql)
+
+    if args.update:
+        counts=cursor.fetchone()
+        print("Staged %d time series records for LABSTAT section '%s'." % (counts['records'],section))
+
+        if counts['undated'] or counts['orphans']:
+            raise ValueError("Staged time series for LABSTAT section '%s' has %d undated records and %d records for unknown series." % (
+                section,
+                counts['undated'],
+                counts['orphans']
+            ))
+
+    # anti-join against the live table outside the transaction, so only new and changed rows are merged
+    sql="""/* UNCHANGED BLSTimeSeriesStaging DATA */
+DELETE
+    BLSTimeSeriesStaging
+FROM
+    BLSTimeSeriesStaging
+    JOIN BLSTimeSeries ON BLSTimeSeries.series_id=BLSTimeSeriesStaging.series_id AND BLSTimeSeries.date=BLSTimeSeriesStaging.date
+WHERE
+    BLSTimeSeries.year<=>BLSTimeSeriesStaging.year
+    AND BLSTimeSeries.period<=>BLSTimeSeriesStaging.period
+    AND BLSTimeSeries.value<=>BLSTimeSeriesStaging.value
+    AND BLSTimeSeries.footnote_codes<=>BLSTimeSeriesStaging.footnote_codes"""
+    execute(cursor,args,sql)
+
+    if args.update:
+        print("Dropped %d unchanged staged time series records for LABSTAT section '%s'." % (cursor.rowcount,section))
+
+    # publish
+    print("Merging new and changed staged time series data into database for LABSTAT section '%s'." % section)
 
-    # main code
     try:
-        tables=['BLSItems','BLSSeries','BLSTimeSeries','BLSTimeSeriesHistory']
-        
-        with connection.cursor() as cursor:
-            # drop tables
-            if args.truncate:
-                raise Exception("If you really want to drop the tables, comment out this line.")
-            
-                for table in reversed(tables):
-                    print("WARNING: Dropping table %s if it exists." % table)
-                    sql="DROP TABLE IF EXISTS %s" % table
-                    cursor.execute(sql)
-            
-            # create BLSItems table
-            print("Creating BLSItems table if needed.")
-            sql="""/* CREATE BLSItems TABLE */
+        for sql in [
+            "START TRANSACTION",
+            """/* MERGE BLSTimeSeries DATA */
+INSERT INTO BLSTimeSeries
+    (series_id,date,year,period,value,footnote_codes)
+SELECT
+    series_id,date,year,period,value,footnote_codes
+FROM
+    BLSTimeSeriesStaging
+ON DUPLICATE KEY UPDATE
+    year=VALUES(year),
+    period=VALUES(period),
+    value=VALUES(value),
+    footnote_codes=VALUES(footnote_codes)""",
+            """/* MERGE BLSTimeSeriesHistory DATA */
+INSERT IGNORE INTO BLSTimeSeriesHistory
+    (series_id,date,year,period,value,footnote_codes)
+SELECT
+    series_id,date,year,period,value,footnote_codes
+FROM
+    BLSTimeSeriesStaging""",
+            "COMMIT",
+        ]:
+            execute(cursor,args,sql)
+
+    except:
+        execute(cursor,args,"ROLLBACK")
+        raise
+
+def split(args,filename,chunks):
+    """Split a time series file into about equal temporary files, only ever between series, returning them with their
+    row and byte counts. Each file keeps the headers so IGNORE n LINES still applies."""
+    target,files=getsize(filename)/chunks,[]
+
+    with open(filename,newline='',encoding='latin-1') as datafile:
+        headers=[datafile.readline() for n in range(args.ignore)]
+        chunkfile,last=None,None
+
+        for line in datafile:
+            series=line.split(separator(args.column),1)[0].strip()
+
+            if chunkfile==None or (series!=last and files[-1][2]>=target):
+                chunkfile=NamedTemporaryFile(dir='/tmp',delete=args.keep,mode='w+',newline='',encoding='latin-1')
+                chunkfile.writelines(headers)
+                files.append([chunkfile,0,0])
+
+            chunkfile.write(line)
+            files[-1][1]+=1
+            files[-1][2]+=len(line)
+            last=series
+
+    for chunkfile,rows,size in files:
+        chunkfile.flush()
+        chmod(chunkfile.name,0o644) # change file permissions
+
+    return files
+
+def load_chunk(connection,args,section,filename):
+    """Load one chunk of a time series file, retrying it on its own after a failure."""
+    for attempt in range(args.retries+1):
+        try:
+            connection.ping(reconnect=True) # a failed attempt may have lost the connection
+
+            with connection.cursor() as cursor,metrics.context(section=section,stage='data'):
+                return load_data(cursor,args,section,filename)
+
+        except (DatabaseError,OperationalError) as e:
+            if attempt==args.retries:
+                raise
+
+            print("Retrying chunk %s for LABSTAT section '%s' after: %s" % (filename,section,str(e)))
+            metrics.record('retry',section=section,attempts=1)
+            sleep(2**attempt)
+
+def load_chunks(chunkers,args,section,filename):
+    """Load a time series file as series aligned chunks concurrently over the chunk loaders' connections."""
+    files=split(args,filename,args.chunks)
+    print("Loading %d chunks of time series data for LABSTAT section '%s'." % (len(files),section))
+    started,rows,size,done,futures=time(),0,0,0,{}
+
+    try:
+        futures={chunkers.submit(load_chunk,args,section,chunkfile.name):(count,length) for chunkfile,count,length in files}
+
+        for future in as_completed(futures):
+            future.result()
+            done,rows,size=done+1,rows+futures[future][0],size+futures[future][1]
+            elapsed=max(time()-started,1e-6)
+            print("Loaded %d/%d chunks for LABSTAT section '%s': %d rows, %.0f rows/s, %.0f bytes/s." % (
+                done,
+                len(files),
+                section,
+                rows,
+                rows/elapsed,
+                size/elapsed
+            ))
+
+    finally:
+        wait(futures) # other chunks may still be reading their files
+
+        for chunkfile,count,length in files:
+            chunkfile.close()
+
+def load_delta(cursor,args,section,filename,snapshot,full,chunkers=None,steps=None):
+    """Load only the time series rows that differ from the snapshot of the file last loaded, then update the snapshot.
+
+    A full load is done when there is no snapshot, when asked to (--force) or when either file turns out not to be
+    sorted."""
+    if not full and exists(snapshot):
+        with NamedTemporaryFile(dir='/tmp',delete=args.keep,mode='w+',newline='',encoding='latin-1') as deltafile:
+            try:
+                counts=delta(args,snapshot,filename,deltafile)
+
+            except ValueError as e: # only a file that cannot be compared falls back, not a failure to load the delta
+                print("%s Doing a full load." % str(e))
+                full=True
+
+            else:
+                metrics.record('delta',**counts)
+                print("Delta for LABSTAT section '%s': %d inserted, %d changed, %d unchanged, %d deleted (not loaded) rows." % (
+                    section,
+                    counts['inserted'],
+                    counts['changed'],
+                    counts['unchanged'],
+                    counts['deleted']
+                ))
+
+                if counts['inserted']+counts['changed']>0:
+                    load_data(cursor,args,section,deltafile.name,chunkers,steps)
+
+    else:
+        full=True
+
+    if full:
+        load_data(cursor,args,section,filename,chunkers,steps)
+
+    if args.update:
+        copyfile(filename,snapshot+".tmp")
+        replace(snapshot+".tmp",snapshot) # atomic, so a crash never leaves a torn snapshot
+
+def create_tables(cursor,args):
+    """Create the MySQL tables if needed, adding any columns missing from existing ones. Returns the columns added, as
+    (table, column)."""
+    # create BLSItems table
+    print("Creating BLSItems table if needed.")
+    sql="""/* CREATE BLSItems TABLE */
 CREATE TABLE IF NOT EXISTS BLSItems
 (
     id bigint not null primary key auto_increment,
@@ -112,23 +872,19 @@ CREATE TABLE IF NOT EXISTS BLSItems
     unique key unique_key (section,item_code),
     constraint parent_id_fkey foreign key (parent_id) references BLSItems (id)
 )"""
-            if args.update:
-                cursor.execute(sql)  
-                
-            else:
-                print(sql)
+    execute(cursor,args,sql)
 
-            # create BLSSeries table
-            print("Creating BLSSeries table if needed.")
-            sql="""/* CREATE BLSSeries TABLE */
+    # create BLSSeries table
+    print("Creating BLSSeries table if needed.")
+    sql="""/* CREATE BLSSeries TABLE */
 CREATE TABLE IF NOT EXISTS BLSSeries 
 (
     id bigint not null primary key auto_increment,
     timestamp timestamp not null default current_timestamp on update current_timestamp,
     captured datetime not null default current_timestamp,
     section char(2) null,
-    series_id varchar(17) not null,unique key unique_key (series_id),
-    area_code varchar(4),key area_code_key (area_code),
+    series_id varchar(32) not null,unique key unique_key (series_id),
+    area_code varchar(16),key area_code_key (area_code),
     item_code varchar(716),key item_code_key (item_code),
     seasonal char(1),
     periodicity_code char(1),
@@ -144,21 +900,17 @@ CREATE TABLE IF NOT EXISTS BLSSeries
     end_date date,
     constraint BLSSeries_section_item_code_fkey foreign key (section,item_code) references BLSItems (section,item_code) on delete cascade
 )"""
-            if args.update:
-                cursor.execute(sql)  
-                
-            else:
-                print(sql)
-            
-            # create BLSTimeSeries and BLSTimeSeriesHistory tables if needed
-            print("Creating BLSTimeSeries table if needed.")
-            sql="""/* CREATE BLSTimeSeries TABLE */
+    execute(cursor,args,sql)
+    
+    # create BLSTimeSeries and BLSTimeSeriesHistory tables if needed
+    print("Creating BLSTimeSeries table if needed.")
+    sql="""/* CREATE BLSTimeSeries TABLE */
 CREATE TABLE IF NOT EXISTS BLSTimeSeries
 (
     id bigint not null primary key auto_increment,
     timestamp timestamp not null default current_timestamp on update current_timestamp,
     captured datetime not null default current_timestamp,
-    series_id varchar(17) not null,key series_id_key (series_id),
+    series_id varchar(32) not null,key series_id_key (series_id),
     date date,key date_key (date),
     year int,
     period varchar(3),
@@ -167,363 +919,423 @@ CREATE TABLE IF NOT EXISTS BLSTimeSeries
     unique key unique_key (series_id,date),
     constraint BLSTimeSeries_series_id_fkey foreign key (series_id) references BLSSeries (series_id) on delete cascade
 )"""
-            if args.update:
-                cursor.execute(sql)  
+    execute(cursor,args,sql)
                 
-            else:
-                print(sql)
-                        
-            print("Creating BLSTimeSeriesHistory table if needed.")
-            sql="""/* CREATE BLSTimeSeries TABLE */
+    print("Creating BLSTimeSeriesHistory table if needed.")
+    sql="""/* CREATE BLSTimeSeries TABLE */
 CREATE TABLE IF NOT EXISTS BLSTimeSeriesHistory
 (
     id bigint not null primary key auto_increment,
     timestamp timestamp not null default current_timestamp on update current_timestamp,
     captured datetime not null default current_timestamp,
     seq int not null default 1,
-    series_id varchar(17) not null,key series_id_key (series_id),
+    series_id varchar(32) not null,key series_id_key (series_id),
     date date,key date_key (date),
     year int,
     period varchar(3),
     value decimal(15,3),
     footnote_codes varchar(16),
+    valid_to datetime, # captured time of the revision that superseded this value, NULL while current
     unique key unique_key (series_id,date,value), # use of value in unique key will make this version capture revisions
     constraint BLSTimeSeriesHistory_series_id_fkey foreign key (series_id) references BLSSeries (series_id) on delete cascade    
 )"""
-            if args.update:
-                cursor.execute(sql)  
-                
-            else:
-                print(sql)
+    execute(cursor,args,sql)
 
-            # download and process items data
-            url="%s/%s" % (args.url,args.items)
-            print("Fetching item metadata from %s" %url)
-            response=get(url)
-            
-            if response.status_code/100!=2:
-                raise ValueError("Status code %d returned for URL %s" % (response.status_code,url))
+    # add the validity interval to a history table created before it existed
+    added=[]
+    sql="SELECT COUNT(*) AS present FROM information_schema.columns WHERE table_schema=DATABASE() AND table_name='BLSTimeSeriesHistory' AND column_name='valid_to'"
+    execute(cursor,args,sql)
 
-            with NamedTemporaryFile(dir='/tmp',delete=args.keep,mode='w+') as tempfile:
-                tempfile.write(response.text)
-                tempfile.flush()
-                chmod(tempfile.name,0o644) # change file permissions   
-                
-                if args.section=='ap':
-                    sql="""/* LOAD BLSItems DATA */
-LOAD DATA %s INFILE
-    '%s'
-REPLACE INTO TABLE
-    BLSItems
-FIELDS TERMINATED BY '%s'
-LINES TERMINATED BY '%s'
-IGNORE %d LINES
-(
-    @item_code,
-    @item_name
-)
-SET    
-    item_code=TRIM(@item_code),
-    item_name=TRIM(@item_name),
-    section='%s'""" % (
-                            'LOCAL' if args.local else '',
-                            tempfile.name,
-                            args.column,
-                            args.newline,
-                            args.ignore,
-                            args.section
-                    )
-    
-                elif args.section in ['cu','su']:
-                    sql="""/* LOAD BLSItems DATA */
-LOAD DATA %s INFILE
-    '%s'
-REPLACE INTO TABLE
-    BLSItems
-FIELDS TERMINATED BY '%s'
-LINES TERMINATED BY '%s'
-IGNORE %d LINES
-(
-    @item_code,
-    @item_name,
-    @display_level,
-    @selectable,
-    @sort_sequence
-)
-SET
-    item_code=TRIM(@item_code),
-    item_name=TRIM(REGEXP_REPLACE(@item_name,'\\\\s+',' ')),
-    display_level=CASE WHEN LENGTH(TRIM(@display_level))>0 THEN @display_level+0 END,
-    selectable=CASE @selectable WHEN 'T' THEN 1 WHEN 'F' THEN 0 END,
-    sort_sequence=CASE WHEN LENGTH(TRIM(@sort_sequence))>0 THEN @sort_sequence+0 END,
-    section='%s'""" % (
-                            'LOCAL' if args.local else '',
-                            tempfile.name,
-                            args.column,
-                            args.newline,
-                            args.ignore,
-                            args.section
-                    )                    
-        
-                else:
-                    raise ValueError("Don't know how to load data for BLS LABSTAT section '%s'." % args.section)
+    if args.update and cursor.fetchone()['present']==0:
+        print("Adding valid_to column to BLSTimeSeriesHistory table.")
+        sql="ALTER TABLE BLSTimeSeriesHistory ADD COLUMN valid_to datetime"
+        execute(cursor,args,sql)
+        added.append(('BLSTimeSeriesHistory','valid_to'))
 
-                print("Bulk load of items metadata into database for LABSTAT section '%s'." % args.section)
-                
-                if args.update:
-                    cursor.execute(sql)  
+    # widen the columns of tables created before sections with longer series ids and area codes (la, sm) were supported
+    widths=[
+        ('BLSSeries','series_id',32,'varchar(32) not null'),
+        ('BLSSeries','area_code',16,'varchar(16)'),
+        ('BLSTimeSeries','series_id',32,'varchar(32) not null'),
+        ('BLSTimeSeriesHistory','series_id',32,'varchar(32) not null'),
+    ]
+    sql="SELECT TABLE_NAME AS name,COLUMN_NAME AS field,CHARACTER_MAXIMUM_LENGTH AS width FROM information_schema.columns WHERE table_schema=DATABASE() AND table_name IN ('BLSSeries','BLSTimeSeries','BLSTimeSeriesHistory') AND column_name IN ('series_id','area_code')"
+    execute(cursor,args,sql)
+    present={(row['name'],row['field']):row['width'] for row in cursor.fetchall()} if args.update else {}
+    narrow=[(table,column,definition) for table,column,width,definition in widths if present.get((table,column),width)<width]
 
-                else:
-                    print(sql)
+    if len(narrow)>0:
+        execute(cursor,args,"SET foreign_key_checks=0") # the series ids on both sides of each foreign key are widened in turn
 
-            # download and process series metadata
-            url="%s/%s" % (args.url,args.series)
-            print("Fetching series metadata from %s" %url)
-            response=get(url)
-            
-            if response.status_code/100!=2:
-                raise ValueError("Status code %d returned for URL %s" % (response.status_code,url))
+        try:
+            for table in dict.fromkeys(table for table,column,definition in narrow):
+                print("Widening %s columns of %s table." % (",".join(column for name,column,definition in narrow if name==table),table))
+                sql="ALTER TABLE %s %s" % (table,",".join("MODIFY %s %s" % (column,definition) for name,column,definition in narrow if name==table))
+                execute(cursor,args,sql)
 
-            with NamedTemporaryFile(dir='/tmp',delete=args.keep,mode='w+') as tempfile:
-                tempfile.write(response.text)
-                tempfile.flush()
-                chmod(tempfile.name,0o644) # change file permissions   
-                
-                if args.section=='ap':
-                    sql="""/* LOAD BLSSeries DATA */
-LOAD DATA %s INFILE
-    '%s'
-REPLACE INTO TABLE
-    BLSSeries
-FIELDS TERMINATED BY '%s'
-LINES TERMINATED BY '%s'
-IGNORE %d LINES
+        finally:
+            execute(cursor,args,"SET foreign_key_checks=1")
+
+    # create BLSLoads table, whose latest id is the load generation readers cache against
+    print("Creating BLSLoads table if needed.")
+    sql="""/* CREATE BLSLoads TABLE */
+CREATE TABLE IF NOT EXISTS BLSLoads
 (
-    @series_id,
-    @area_code,
-    @item_code,
-    @series_title,
-    @footnote_codes,
-    @begin_year,
-    @begin_period,
-    @end_year,
-    @end_period
-)
-SET
-    section='%s',
-    series_id=TRIM(@series_id),
-    area_code=TRIM(@area_code),
-    item_code=TRIM(@item_code),
-    series_title=TRIM(@series_title),
-    footnote_codes=CASE WHEN LENGTH(TRIM(@footnote_codes))>0 THEN TRIM(@footnote_codes) END,
-    begin_year=CASE WHEN LENGTH(TRIM(@begin_year))>0 THEN @begin_year+0 END,
-    begin_period=CASE WHEN LENGTH(TRIM(@begin_period))>0 THEN @begin_period END,
-    end_year=CASE WHEN LENGTH(TRIM(@end_year))>0 THEN @end_year+0 END,
-    end_period=CASE WHEN LENGTH(TRIM(@end_period))>0 THEN @end_period END,
-    begin_date=CASE
-                    WHEN begin_year>0 AND begin_period LIKE 'M%%' AND begin_period<>'M13' THEN STR_TO_DATE(CONCAT(begin_year,begin_period,'01'),'%%YM%%m%%d') 
-                    WHEN begin_year>0 AND begin_period='S01' THEN STR_TO_DATE(CONCAT(begin_year,'0101'),'%%Y%%m%%d') 
-                    WHEN begin_year>0 AND begin_period='S02' THEN STR_TO_DATE(CONCAT(begin_year,'0701'),'%%Y%%m%%d')
-                    WHEN begin_year>0 AND begin_period IN ('M13','S03') THEN STR_TO_DATE(CONCAT(begin_year,'0101'),'%%Y%%m%%d') 
-                END,
-    end_date=CASE 
-                WHEN end_year>0 AND end_period LIKE 'M%%' AND end_period<>'M13' THEN LAST_DAY(STR_TO_DATE(CONCAT(end_year,end_period,'01'),'%%YM%%m%%d')) 
-                WHEN end_year>0 AND end_period='S01' THEN STR_TO_DATE(CONCAT(begin_year,'0630'),'%%Y%%m%%d') 
-                WHEN end_year>0 AND end_period='S02' THEN STR_TO_DATE(CONCAT(begin_year,'1231'),'%%Y%%m%%d') 
-                WHEN begin_year>0 AND begin_period IN ('M13','S03') THEN STR_TO_DATE(CONCAT(begin_year,'1231'),'%%Y%%m%%d') 
-              END,
-    seasonal=CASE WHEN series_title LIKE '%%not seasonally adjusted%%' THEN 'U' ELSE 'S' END""" % (
-                            'LOCAL' if args.local else '',
-                            tempfile.name,
-                            args.column,
-                            args.newline,
-                            args.ignore,
-                            args.section
-                    )
-                        
-                elif args.section in ['cu','su']:
-                    sql="""/* LOAD BLSSeries DATA */
-LOAD DATA %s INFILE
-    '%s'
-REPLACE INTO TABLE
-    BLSSeries
-FIELDS TERMINATED BY '%s'
-LINES TERMINATED BY '%s'
-IGNORE %d LINES
+    id bigint not null primary key auto_increment,
+    timestamp timestamp not null default current_timestamp on update current_timestamp,
+    captured datetime not null default current_timestamp,
+    sections varchar(256)
+)"""
+    execute(cursor,args,sql)
+
+    # create BLSFiles table, the content of each file loaded, so the download cache only skips what this database has
+    print("Creating BLSFiles table if needed.")
+    sql="""/* CREATE BLSFiles TABLE */
+CREATE TABLE IF NOT EXISTS BLSFiles
 (
-    @series_id,
-    @area_code,
-    @item_code,
-    @seasonal,
-    @periodicity_code,
-    @base_code,
-    @base_period,
-    @series_title,
-    @footnote_codes,
-    @begin_year,
-    @begin_period,
-    @end_year,
-    @end_period
-)
-SET
-    section='%s',
-    series_id=TRIM(@series_id),
-    area_code=TRIM(@area_code),
-    item_code=TRIM(@item_code),
-    seasonal=CASE WHEN LENGTH(TRIM(@seasonal))>0 THEN TRIM(@seasonal) END,
-    periodicity_code=CASE WHEN LENGTH(TRIM(@periodicity_code))>0 THEN TRIM(@periodicity_code) END,
-    base_code=CASE WHEN LENGTH(TRIM(@base_code))>0 THEN TRIM(@base_code) END,
-    base_period=CASE WHEN LENGTH(TRIM(@base_period))>0 THEN TRIM(@base_period) END,
-    series_title=TRIM(@series_title),
-    footnote_codes=CASE WHEN LENGTH(TRIM(@footnote_codes))>0 THEN TRIM(@footnote_codes) END,
-    begin_year=CASE WHEN LENGTH(TRIM(@begin_year))>0 THEN @begin_year+0 END,
-    begin_period=CASE WHEN LENGTH(TRIM(@begin_period))>0 THEN @begin_period END,
-    end_year=CASE WHEN LENGTH(TRIM(@end_year))>0 THEN @end_year+0 END,
-    end_period=CASE WHEN LENGTH(TRIM(@end_period))>0 THEN @end_period END,
-    begin_date=CASE
-                    WHEN begin_year>0 AND begin_period LIKE 'M%%' AND begin_period<>'M13' THEN STR_TO_DATE(CONCAT(begin_year,begin_period,'01'),'%%YM%%m%%d') 
-                    WHEN begin_year>0 AND begin_period='S01' THEN STR_TO_DATE(CONCAT(begin_year,'0101'),'%%Y%%m%%d') 
-                    WHEN begin_year>0 AND begin_period='S02' THEN STR_TO_DATE(CONCAT(begin_year,'0701'),'%%Y%%m%%d')
-                    WHEN begin_year>0 AND begin_period IN ('M13','S03') THEN STR_TO_DATE(CONCAT(begin_year,'0101'),'%%Y%%m%%d') 
-                END,
-    end_date=CASE 
-                WHEN end_year>0 AND end_period LIKE 'M%%' AND end_period<>'M13' THEN LAST_DAY(STR_TO_DATE(CONCAT(end_year,end_period,'01'),'%%YM%%m%%d')) 
-                WHEN end_year>0 AND end_period='S01' THEN STR_TO_DATE(CONCAT(begin_year,'0630'),'%%Y%%m%%d') 
-                WHEN end_year>0 AND end_period='S02' THEN STR_TO_DATE(CONCAT(begin_year,'1231'),'%%Y%%m%%d') 
-                WHEN begin_year>0 AND begin_period IN ('M13','S03') THEN STR_TO_DATE(CONCAT(begin_year,'1231'),'%%Y%%m%%d') 
-              END""" % (
-                            'LOCAL' if args.local else '',
-                            tempfile.name,
-                            args.column,
-                            args.newline,
-                            args.ignore,
-                            args.section
-                    )
-
-                print("Bulk load of series metadata into database for LABSTAT section '%s'." % args.section)
-                
+    id bigint not null primary key auto_increment,
+    timestamp timestamp not null default current_timestamp on update current_timestamp,
+    captured datetime not null default current_timestamp,
+    url varchar(256) not null,unique key unique_key (url),
+    sha256 char(64)
+)"""
+    execute(cursor,args,sql)
+    return added
+
+STAGES={
+    'items':('item metadata',load_items),
+    'series':('series metadata',load_series),
+    'data':('time series data',load_data),
+}
+
+def loaded_files(cursor,args):
+    """Content hash of every file the database records as loaded, by URL, or None when not updating (and so trusting
+    the cache alone)."""
+    if not args.update:
+        return None
+
+    sql="SELECT url,sha256 FROM BLSFiles"
+    execute(cursor,args,sql)
+    return {row['url']:row['sha256'] for row in cursor.fetchall()}
+
+def record_file(cursor,args,entry):
+    """Record in the database the content of a file just loaded into it."""
+    sql=upsert(cursor.connection,'BLSFiles',{'url':"'%s'" % entry['url'].replace("'","''"),'sha256':"'%s'" % entry['sha256']})
+    execute(cursor,args,sql)
+
+def urls(args,section,stage):
+    """URLs of a section's files of one kind, named on the command line or else from the section registry."""
+    folder,names,listing=args.url % section if "%s" in args.url else args.url,getattr(args,stage),None
+
+    if names!=None:
+        return ["%s/%s" % (folder,name % section if "%s" in name else name) for name in names.split(',')]
+
+    if stage=='data' and not isinstance(SECTIONS[section]['data'],list):
+        response=session().get(folder+"/")
+
+        if response.status_code//100!=2:
+            raise ValueError("Status code %d returned for URL %s/" % (response.status_code,folder))
+
+        listing=response.text
+
+    return ["%s/%s" % (folder,name) for name in filenames(section,stage,listing)]
+
+def digest(filename,chunksize=1<<20):
+    """SHA-256 of a file's content."""
+    with open(filename,'rb') as datafile:
+        result=sha256()
+
+        for chunk in iter(lambda:datafile.read(chunksize),b''):
+            result.update(chunk)
+
+    return result.hexdigest()
+
+def archive(args):
+    """Archive of vintages named by --archive, if any."""
+    if args.archive==None:
+        return None
+
+    from vintages import Archive # optional, only needed to archive (it needs zstandard)
+    return Archive(args.archive,separator(args.column))
+
+def prefetch(args,cache,manifest,url):
+    """Download a file into a temporary file that is left open for its load stage, and kept until the stage is done so
+    that a resumed run can reuse it. Returns no file for a stage a resumed run has already done."""
+    record,started=manifest.file(url),time()
+
+    if 'done' in record.get('steps',[]):
+        return None,record['entry'],0.0
+
+    if 'entry' in record and exists(record['path']) and record['entry']['sha256']==digest(record['path']):
+        print("Reusing %s downloaded by the interrupted run." % url)
+        return open(record['path'],'r+b'),record['entry'],time()-started
+
+    tempfile=NamedTemporaryFile(dir='/tmp',delete=False,mode='w+b')
+    print("Fetching %s" % url)
+
+    try:
+        entry=download(url,tempfile,args.chunksize,None if args.force else cache.get(url))
+
+    except:
+        tempfile.close()
+        unlink(tempfile.name)
+        raise
+
+    if entry['status']!=304:
+        manifest.put(url,entry=entry,path=tempfile.name)
+
+    if entry['status']!=304 and cache.archive!=None and args.update: # here, so compression overlaps earlier loads
+        with metrics.timed('archive',file=url.split('/')[-1]) as timing:
+            vintage=cache.archive.put(url,tempfile.name,entry)
+            timing['vintages']=int(vintage!=None)
+
+        print("Archived %s as vintage %s." % (url,vintage) if vintage!=None else "Already archived %s." % url)
+
+    return tempfile,entry,time()-started
+
+class Lookahead:
+    """Downloads of a list of files, started a fixed number of files ahead of the one being loaded so that a section
+    with many large data files never has more than that many on disk."""
+    def __init__(self,downloads,args,cache,manifest,urls,depth):
+        self.downloads,self.args,self.cache,self.manifest,self.urls,self.depth,self.futures=downloads,args,cache,manifest,urls,depth,[]
+        self.fill(0)
+
+    def fill(self,n):
+        while len(self.futures)<min(n+self.depth,len(self.urls)):
+            self.futures.append(self.downloads.submit(prefetch,self.args,self.cache,self.manifest,self.urls[len(self.futures)]))
+
+    def __iter__(self):
+        for n in range(len(self.urls)):
+            self.fill(n+1)
+            yield self.futures[n]
+
+    def close(self):
+        for future in self.futures: # closing twice is harmless, and catches files of stages that failed, kept for --resume
+            if not future.cancel() and future.exception()==None and future.result()[0]!=None:
+                future.result()[0].close()
+
+def load_section(connection,args,cache,manifest,section,state,pending,chunkers=None):
+    """Load some of a section's prefetched files, in foreign key order, on one connection, recording each step done."""
+    with connection.cursor() as cursor:
+        for stage,lookahead in pending:
+            name,loader=STAGES[stage]
+
+            for future in lookahead:
+                started=time()
+                tempfile,entry,elapsed=future.result()
+                waited=time()-started
+                steps=Steps(manifest,entry['url'])
+
+                if tempfile==None:
+                    print("Skipping %s for LABSTAT section '%s', done by the interrupted run." % (name,section))
+                    continue
+
+                with tempfile,metrics.context(section=section,stage=stage,file=entry['url'].split('/')[-1]):
+                    metrics.record('download',status=str(entry['status']),bytes=entry['size'] if entry['status']!=304 else 0,seconds=elapsed)
+
+                    if entry['status']==304 and state['reload']: # the section is being reloaded, so the content is needed after all
+                        with metrics.timed('download',status='200') as timing:
+                            entry=download(entry['url'],tempfile,args.chunksize)
+                            timing['bytes']=entry['size']
+
+                        manifest.put(entry['url'],entry=entry,path=tempfile.name)
+
+                    if entry['changed'] or state['reload']:
+                        since=history_since(cursor,args,manifest,entry['url']) if stage=='data' else None
+
+                        if stage=='data' and args.delta: # against the snapshot only if it is of what the database has
+                            load_delta(cursor,args,section,tempfile.name,cache.snapshot(entry['url']),state['reload'] or cache.get(entry['url'])==None,chunkers,steps)
+
+                        elif stage=='data':
+                            load_data(cursor,args,section,tempfile.name,chunkers,steps)
+
+                        else:
+                            if 'loaded' not in steps: # upserted in place, so the stages after it need not reload
+                                loader(cursor,args,section,tempfile.name)
+                                steps.add('loaded')
+
+                        if stage=='data' and 'valid' not in steps: # after the history load, however it was done
+                            close_history(cursor,args,since)
+                            steps.add('valid')
+
+                        record_file(cursor,args,entry)
+                        state['loaded']=True
+                        manifest.section(section,state)
+
+                    else:
+                        print("Skipping load of unchanged %s for LABSTAT section '%s'." % (name,section))
+
                 if args.update:
-                    cursor.execute(sql)  
+                    cache.put(entry['url'],entry)
+
+                steps.add('done')
+
+                if args.keep: # not needed by a resumed run any more
+                    unlink(tempfile.name)
+
+                metrics.record('stage',section=section,stage=stage,file=entry['url'].split('/')[-1],wait=waited,work=time()-started-waited)
+                print("Stage %s for LABSTAT section '%s' from %s: downloaded in %.2fs, waited %.2fs, worked %.2fs." % (
+                    stage,
+                    section,
+                    entry['url'].split('/')[-1],
+                    elapsed,
+                    waited,
+                    time()-started-waited
+                ))
+
+def main(argv=None):
+    # arguments
+    from argparse import ArgumentParser
+    args=ArgumentParser();
+    args.add_argument("-D","--database",type=str,default="database=Analysis",help='Database connection.') 
+    args.add_argument("-T","--truncate",action='store_true',help="Drop tables.")
+    args.add_argument("-U","--update",action='store_true',help="Set to update database.")
+    args.add_argument("-H","--hidden",action='store_true',help="Prevent arguments and secrets being echoed to the terminal.")    
+    args.add_argument("section",type=str,nargs='+',choices=sorted(SECTIONS),help="Sections of LABSTAT to extract.")
+    args.add_argument("-u","--url",type=str,default='https://download.bls.gov/pub/time.series/%s',help="URL for data folder.")
+    args.add_argument("-n","--newline",type=str,default=r'\r\n',help="Line break code for data files.")
+    args.add_argument("-c","--column",type=str,default=r'\t',help="Column break code for data files.")
+    args.add_argument("-I","--ignore",type=int,default=1,help="Header lines to ignore in files.")
+    args.add_argument("-s","--series",type=str,default=None,help="Name of data file for series metadata (defaults to the section registry).")
+    args.add_argument("-d","--data",type=str,default=None,help="Comma separated names of data files for time series (defaults to the section registry).")
+    args.add_argument("-k","--keep",action='store_false',help="Set to keep temporary files (usually for debugging).")
+    args.add_argument("-i","--items",type=str,default=None,help="Name of data file for item metadata (defaults to the section registry).")
+    args.add_argument("-w","--warnings",action='store_true',help="Set to catch database warnings.")
+    args.add_argument("-L","--local",action='store_true',help="Set to use LOAD DATA LOCAL INFILE rather than just LOAD DATA INFILE.")
+    args.add_argument("-z","--chunksize",type=int,default=1<<20,help="Size in bytes of chunks streamed from downloads to disk.")
+    args.add_argument("-C","--cache",type=str,default="%s/.cache/labstat" % getenv("HOME"),help="Folder for the conditional download cache.")
+    args.add_argument("-j","--jobs",type=int,default=None,help="Sections to load at once, each on its own connection (defaults to all of them).")
+    args.add_argument("-l","--lookahead",type=int,default=2,help="Time series files per section to download ahead of the one being loaded.")
+    args.add_argument("-P","--prefetch",type=int,default=None,help="Files to download at once ahead of their load stage (defaults to enough for every section).")
+    args.add_argument("-x","--delta",action='store_true',help="Set to load only time series rows that changed since the file was last loaded.")
+    args.add_argument("-S","--staging",action='store_true',help="Set to load time series into a staging table and merge it into the live tables in one transaction.")
+    args.add_argument("-N","--normalize",action='store_true',help="Set to clean files in Python before loading them rather than with SQL expressions.")
+    args.add_argument("-K","--chunks",type=int,default=1,help="Series aligned chunks to split time series files into and load at once, each on its own connection.")
+    args.add_argument("-r","--retries",type=int,default=2,help="Times to retry a chunk that failed to load.")
+    args.add_argument("-f","--force",action='store_true',help="Set to download and load every file even if it has not changed.")
+    args.add_argument("-R","--resume",action='store_true',help="Set to carry on from the steps a failed run with the same sections did not finish, reusing its downloads.")
+    args.add_argument("-A","--archive",type=str,default=None,help="Folder to keep a compressed vintage of every file downloaded in (see vintages.py).")
+    args.add_argument("-M","--metrics",type=str,default=None,help="File to write the JSON run record of timed stages to.")
+    args.add_argument("-E","--prometheus",type=str,default=None,help="File to write run metrics to in the Prometheus textfile format.")
+    args=args.parse_args(argv);
+    args.section=list(dict.fromkeys(args.section)) # in order, without repeats
+
+    # initialize
+    print(__doc__,"\nParameters:",vars(args) if not args.hidden else 'hidden')
+
+    if not args.warnings:
+        filterwarnings('ignore',category=Warning)
+    
+    # connect to database
+    database=parse(args.database,args.hidden)
+
+    if embedded(database): # always loaded from normalized files, by one connection at a time
+        if args.staging:
+            raise ValueError("Staging tables need a MySQL database.")
 
-                else:
-                    print(sql)
+        args.normalize,args.jobs,args.chunks=True,1,1
+
+    metrics.start()
+    connection=open_connection(database)
+    workers=Workers(database,args.jobs or len(args.section))
+    cache,status=DownloadCache(args.cache,archive(args),identity(database)),0
+    manifest=Manifest(cache.manifest(args.section),args.resume,args.update)
+    state={section:{'reload':args.force or manifest.section(section)['reload'],'loaded':manifest.section(section)['loaded']} for section in args.section}
+    chunkers=Workers(database,args.chunks) if args.chunks>1 else None
+    downloads,pending=ThreadPoolExecutor(max_workers=args.prefetch or (args.lookahead+2)*len(args.section)),{}
+
+    # main code
+    try:
+        tables=['BLSItems','BLSSeries','BLSTimeSeries','BLSTimeSeriesHistory']
         
-            # download and process time series data
-            url="%s/%s" % (args.url,args.data)
-            print("Fetching time series data from %s" % url)
-            response=get(url)
+        with connection.cursor() as cursor:
+            # drop tables
+            if args.truncate:
+                raise Exception("If you really want to drop the tables, comment out this line.")
+            
+                for table in reversed(tables):
+                    print("WARNING: Dropping table %s if it exists." % table)
+                    sql="DROP TABLE IF EXISTS %s" % table
+                    cursor.execute(sql)
             
-            if response.status_code/100!=2:
-                raise ValueError("Status code %d returned for URL %s" % (response.status_code,url))
+            # create tables
+            if isinstance(connection,Embedded):
+                added=create(cursor,tables+['BLSLoads','BLSFiles'],args.update)
 
-            with NamedTemporaryFile(dir='/tmp',delete=args.keep,mode='w+') as tempfile:
-                tempfile.write(response.text)
-                tempfile.flush()
-                chmod(tempfile.name,0o644) # change file permissions  
-                
-                sql="""/* LOAD BLSTimeSeries DATA */
-LOAD DATA %s INFILE
-    '%s'
-REPLACE INTO TABLE
-    BLSTimeSeries
-FIELDS TERMINATED BY '%s'
-LINES TERMINATED BY '%s'
-IGNORE %d LINES
-(
-    @series_id,
-    @year,
-    @period,
-    @value,
-    @footnote_codes
-)
-SET
-    series_id=TRIM(@series_id),
-    year=CASE WHEN LENGTH(TRIM(@year))>0 THEN @year+0 END,
-    period=CASE WHEN LENGTH(TRIM(@period))>0 THEN @period END,
-    value=CASE WHEN LENGTH(TRIM(@value))>0 AND TRIM(@value)<>'-' THEN @value+0e0 END,
-    footnote_codes=CASE WHEN LENGTH(TRIM(@footnote_codes))>0 THEN TRIM(@footnote_codes) END,
-    date=CASE 
-             WHEN year>0 AND period LIKE 'M%%' AND period<>'M13' THEN LAST_DAY(STR_TO_DATE(CONCAT(year,period,'01'),'%%YM%%m%%d')) 
-             WHEN year>0 AND period='S01' THEN STR_TO_DATE(CONCAT(year,'0630'),'%%Y%%m%%d')
-             WHEN year>0 AND period IN ('M13','S02','S03') THEN STR_TO_DATE(CONCAT(year,'1231'),'%%Y%%m%%d')
-         END""" % (
-                    'LOCAL' if args.local else '',
-                    tempfile.name,
-                    args.column,
-                    args.newline,
-                    args.ignore
-                )
+            else:
+                added=create_tables(cursor,args)
 
-                print("Bulk load of time series data into database.")
+            if ('BLSTimeSeriesHistory','valid_to') in added: # intervals of the history already loaded
+                close_history(cursor,args,0)
 
-                if args.update:
-                    cursor.execute(sql)  
+            cache.loaded=loaded_files(cursor,args)
 
-                else:
-                    print(sql)
-                
-                sql="""/* LOAD BLSTimeSeriesHistory DATA */
-LOAD DATA %s INFILE
-    '%s'
-IGNORE INTO TABLE
-    BLSTimeSeriesHistory
-FIELDS TERMINATED BY '%s'
-LINES TERMINATED BY '%s'
-IGNORE %d LINES
-(
-    @series_id,
-    @year,
-    @period,
-    @value,
-    @footnote_codes
-)
-SET
-    series_id=TRIM(@series_id),
-    year=CASE WHEN LENGTH(TRIM(@year))>0 THEN @year+0 END,
-    period=CASE WHEN LENGTH(TRIM(@period))>0 THEN @period END,
-    value=CASE WHEN LENGTH(TRIM(@value))>0 AND TRIM(@value)<>'-' THEN @value+0e0 END,
-    footnote_codes=CASE WHEN LENGTH(TRIM(@footnote_codes))>0 THEN TRIM(@footnote_codes) END,
-    date=CASE 
-             WHEN year>0 AND period LIKE 'M%%' AND period<>'M13' THEN LAST_DAY(STR_TO_DATE(CONCAT(year,period,'01'),'%%YM%%m%%d')) 
-             WHEN year>0 AND period='S01' THEN STR_TO_DATE(CONCAT(year,'0630'),'%%Y%%m%%d')
-             WHEN year>0 AND period IN ('M13','S02','S03') THEN STR_TO_DATE(CONCAT(year,'1231'),'%%Y%%m%%d')
-         END,
-    seq=seq+1""" % (
-                    'LOCAL' if args.local else '',
-                    tempfile.name,
-                    args.column,
-                    args.newline,
-                    args.ignore
-                )
+            # download files in the background, so the network stays busy while earlier stages load
+            for section in args.section:
+                for stage in STAGES:
+                    pending[section,stage]=Lookahead(downloads,args,cache,manifest,urls(args,section,stage),1 if stage!='data' else args.lookahead)
+
+            # load items for every section before any series, since BLSSeries rows lock the BLSItems rows they reference
+            for stages in [['items'],['series','data']]:
+                futures={
+                    workers.submit(load_section,args,cache,manifest,section,state[section],[(stage,pending[section,stage]) for stage in stages],chunkers):section
+                    for section in args.section if 'failed' not in state[section]
+                }
+
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+
+                    except Exception as e:
+                        stdout.flush()
+                        stderr.write("Failed to load LABSTAT section '%s': %s\n" % (futures[future],str(e)))
+                        metrics.record('failure',section=futures[future],error=str(e).split('\n')[0])
+                        state[futures[future]]['failed'],status=True,1
 
-                print("Bulk load of time series data into history table in database.")
-                cursor.execute(sql)
+            loaded=any(map(lambda x:x['loaded'],state.values()))
 
             # trim any blank records from import processes
-            for table in reversed(tables):
+            for table in reversed(tables if loaded and not args.normalize and not manifest.trimmed() else []): # normalization already dropped blank rows
                 print("Trimming any blank records for %s." % table)
                 sql=r"DELETE FROM %s WHERE %s NOT RLIKE '\\w'" % (
                     table,
                     'item_code' if table=='BLSItems' else 'series_id'
                 )
                 
-                if args.update:
-                    cursor.execute(sql)  
+                execute(cursor,args,sql)
+
+            manifest.trimmed(loaded)
 
-                else:
-                    print(sql)
+            if loaded: # a new load generation, so readers drop anything they cached
+                sql="INSERT INTO BLSLoads (sections) VALUES ('%s')" % ",".join(args.section)
+                execute(cursor,args,sql)
+
+            else:
+                print("No files changed since they were last loaded.")
+
+            if status==0:
+                manifest.complete()
                 
-    except (DatabaseError,OperationalError) as e:
-        if 'sql' in locals():
-            stdout.flush()
-            stderr.write("Problem with SQL:\n%s\n%s\n" % (sql,str(e)))
-            
-        raise
+    finally:
+        for lookahead in pending.values():
+            lookahead.close()
+
+        downloads.shutdown()
+        workers.close()
+
+        if chunkers!=None:
+            chunkers.close()
+
+        close_connection(database,connection)
+        metrics.record('memory',peak=peak_memory())
+        metrics.write(args.metrics,args.prometheus,status or int(exc_info()[0]!=None))
 
     # done
-    print("Done.")
+    print("Peak memory %.1f MiB." % (peak_memory()/1048576.0))
+    print("Done." if status==0 else "Done, with failures.")
+    return status
 
 # bootstrap
 if __name__ == "__main__":
     assert(version_info.major>=3)
-    main()
+    exit(main())
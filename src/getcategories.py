@@ -3,14 +3,16 @@
 """Script to fetch and upload CPI taxonomies and weights."""
 
 # modules
-from pymysql import connect,DatabaseError
-from pymysql.cursors import DictCursor
-from sys import stderr,stdout,version_info
-from os import getenv
-from requests import get
+from pymysql import DatabaseError
+from sys import stderr,stdout,version_info,exc_info
 from re import match,sub
+from metrics import Metrics
+from backends import create,upsert,Embedded
+from connections import parse,connect,release,fetch_all
 
-def main():
+metrics=Metrics('getcategories')
+
+def main(argv=None):
     # arguments
     from argparse import ArgumentParser
     args=ArgumentParser();
@@ -22,39 +24,22 @@ def main():
     args.add_argument("-B","--baseurl",type=str,default="https://www.bls.gov/cpi/tables/relative-importance/%d.txt",help='Base URL to fetch data from.')
     args.add_argument("-p","--pattern",type=str,default=r"^(\s+)([^.]+)\s?\.*\s+(\d*\.\d+)\s+(\d*\.\d+)",help="Pattern to identify data lines.")
     args.add_argument("-n","--newline",type=str,default="\n",help="Record terminator (newline).")
+    args.add_argument("-j","--jobs",type=int,default=8,help="Years to download at once.")
     args.add_argument("-d","--delimiter",type=str,default="/",help="String to delimit path in category hierarchy.")
-    args=args.parse_args();
+    args.add_argument("-M","--metrics",type=str,default=None,help="File to write the JSON run record of timed stages to.")
+    args.add_argument("-E","--prometheus",type=str,default=None,help="File to write run metrics to in the Prometheus textfile format.")
+    args=args.parse_args(argv);
 
     # initialize
     print(__doc__,"\nParameters:",vars(args) if not args.hidden else 'hidden')
 
     # connect to database
-    database=dict(map(lambda x:x.split('='),args.database.split(';')))
-
-    if 'pwd' not in database or database['pwd']=='' or database['pwd']==None:
-        database['pwd']=getenv('MYSQLPASSWORD')
-
-    if database['pwd']==None or database['pwd']=='':
-        from getpass import getpass
-        database['pwd']=getpass('Database password:')
-
-    if 'server' not in database or database['server']=='' or database['server']==None:
-        database['server']='localhost'
-
-    print("Connecting to database %s." % (database['server'] if not args.hidden else 'hidden'))
-
-    connection=connect(
-        db=database['database'] if 'database' in database else 'mysql',
-        host=database['server'] if 'server' in database else 'localhost',
-        port=int(database['port']) if 'port' in database else 3306,
-        user=database['uid'] if 'uid' in database else getenv('USER'),
-        password=database['pwd'],
-        cursorclass=DictCursor,
-        autocommit=True
-    )
+    database=parse(args.database,args.hidden)
+    metrics.start()
+    connection=connect(database)
 
     # main code
-    sql,last,top,path,ids=None,"",False,[],{}
+    sql,last,ids=None,"",{}
 
     try:
         with connection.cursor() as cursor:
@@ -64,10 +49,14 @@ def main():
 
                 for table in ['CPICategories']:
                     sql='DROP TABLE IF EXISTS %s' % table
-                    cursor.execute(sql)
+                    metrics.execute(cursor,sql)
                     print("Dropped %s." % table)
 
-                sql="""/* CREATE CPICategories TABLE */
+                if isinstance(connection,Embedded):
+                    create(cursor,['CPICategories'])
+
+                else:
+                    sql="""/* CREATE CPICategories TABLE */
 CREATE TABLE IF NOT EXISTS
     CPICategories
 (
@@ -86,18 +75,29 @@ CREATE TABLE IF NOT EXISTS
     md5 char(32) as (md5(Path)) stored,
     unique key unique_key (md5)
 )"""
-                cursor.execute(sql)
+                    metrics.execute(cursor,sql)
+
                 print("Created CPICategories table.")
 
-            for year in args.year:
-                url=args.baseurl % year if "%d" in args.baseurl else args.baseurl
-                print("Fetching data from",url)
+            # ids of the categories already loaded for these years by path, so parents are found without a query each
+            sql="SELECT id,Path FROM CPICategories WHERE Year IN (%s)" % ",".join(map(str,args.year))
+            metrics.execute(cursor,sql)
+            ids={row['Path'].replace("'","''"):row['id'] for row in cursor.fetchall()} # quoted, as the paths built below are
+            print("Found %d categories already loaded." % len(ids))
 
-                response=get(url)
+            # download every year at once, then process them in order
+            urls=[args.baseurl % year if "%d" in args.baseurl else args.baseurl for year in args.year]
+            print("Fetching data for %d years, %d at once." % (len(urls),args.jobs))
+
+            for year,url,response in zip(args.year,urls,fetch_all(urls,args.jobs)):
+                print("Fetched data from",url)
+                metrics.record('download',file=url.split("/")[-1],status=str(response.status_code),bytes=len(response.content),seconds=response.elapsed.total_seconds())
 
                 if response.status_code/100!=2:
                     raise Exception("HTTP Status Code %d for GET %s" % (response.status_code,url))
 
+                top,path=False,[] # each year's hierarchy starts afresh
+
                 for line in response.text.split(args.newline):
                     category=match(args.pattern,last+line)
 
@@ -130,37 +130,33 @@ CREATE TABLE IF NOT EXISTS
                             path.append(sub(r"^'(.+)'$",r"\1",fields['Category']))
 
                         for k,v in data.items():
+                            key,parent=args.delimiter.join([str(year),k]+path),args.delimiter.join([str(year),k]+path[:-1])
                             fields['IndexName']="'%s'" % k
                             fields['Weight']=v
-                            fields['Path']="'%s'" % args.delimiter.join([str(year),k]+path)
+                            fields['Path']="'%s'" % key
+                            fields.pop('parent_id',None)
 
-                            sql="SELECT * FROM CPICategories WHERE md5=MD5('%s')" % args.delimiter.join([str(year),k]+path[:-1])
-                            cursor.execute(sql)
+                            if parent in ids: # written earlier in the file, or before
+                                fields['parent_id']=str(ids[parent])
 
-                            for row in cursor.fetchall():
-                                fields['parent_id']=str(row['id'])
+                            if isinstance(connection,Embedded): # md5 is a generated column in MySQL
+                                fields['md5']="MD5(%s)" % fields['Path']
 
-                            sql="INSERT INTO CPICategories (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (
-                                ",".join(fields.keys()),
-                                ",".join(fields.values()),
-                                ",".join(map(lambda x:"%s=%s" % x,fields.items()))
-                            )
+                            sql=upsert(connection,'CPICategories',fields)
 
                             if args.update:
-                                cursor.execute(sql)
+                                metrics.execute(cursor,sql)
 
-                            else:
-                                print(sql)
-
-                            # maintain the children list
-                            if 'parent_id' in fields:
-                                sql="UPDATE CPICategories SET children=children+1 WHERE id=%s" % fields['parent_id']
+                                if key not in ids: # a new row, whose id the insert returns
+                                    ids[key]=cursor.lastrowid
 
-                                if args.update:
-                                    cursor.execute(sql)
+                                if ids[key]==None: # not every backend returns one
+                                    sql="SELECT id FROM CPICategories WHERE md5=MD5(%s)" % fields['Path']
+                                    metrics.execute(cursor,sql)
+                                    ids[key]=cursor.fetchone()['id']
 
-                                else:
-                                    print(sql)
+                            else:
+                                print(sql)
 
                     elif match(r"^\s+$",line)==None: # not a blank line
                         last=line
@@ -168,6 +164,39 @@ CREATE TABLE IF NOT EXISTS
                     else: # it's a blank line
                         last=""
 
+            # count the children of every category of these years in one statement after the load, so a rerun gives the same
+            years=",".join(map(str,args.year))
+
+            if isinstance(connection,Embedded): # no multi-table UPDATE in SQLite or DuckDB
+                sql="""/* COUNT CPICategories CHILDREN */
+UPDATE
+    CPICategories
+SET
+    children=(SELECT COUNT(*) FROM CPICategories AS child WHERE child.parent_id=CPICategories.id)
+WHERE
+    Year IN (%s)""" % years
+
+            else:
+                sql="""/* COUNT CPICategories CHILDREN */
+UPDATE
+    CPICategories
+    LEFT JOIN (
+        SELECT parent_id AS id,COUNT(*) AS children
+        FROM CPICategories
+        WHERE Year IN (%s) AND parent_id IS NOT NULL
+        GROUP BY parent_id
+    ) AS counted USING (id)
+SET
+    CPICategories.children=COALESCE(counted.children,0)
+WHERE
+    CPICategories.Year IN (%s)""" % (years,years) # grouped, so MySQL materializes it rather than reading the table it updates
+
+            if args.update:
+                metrics.execute(cursor,sql)
+
+            else:
+                print(sql)
+
     except DatabaseError:
         stdout.flush()
         stderr.write("Problem with SQL:\n%s\n" % sql)
@@ -177,6 +206,10 @@ CREATE TABLE IF NOT EXISTS
         stdout.flush()
         stderr.write('Interrupted.\n')
 
+    finally:
+        release(database,connection)
+        metrics.write(args.metrics,args.prometheus,int(exc_info()[0]!=None))
+
     # done
     print("Done.")
 
@@ -2,24 +2,204 @@
 #encoding: UTF-8
 """Script to download BLS Relative Importance Weights for CPI."""
 # modules
-from pymysql import connect,DatabaseError,Warning,OperationalError
-from pymysql.cursors import DictCursor
-from sys import stderr,stdout,version_info
+from pymysql import DatabaseError,Warning,OperationalError
+from sys import stderr,stdout,version_info,exc_info
 from os import getenv,chmod
 from datetime import datetime,timedelta
-from requests import get
-from xlrd import open_workbook
 from re import sub,search
+from calendar import monthrange
+from metrics import Metrics
+import xlsx
+from backends import Writer,Embedded,placeholder,close_intervals
+from connections import parse,connect,release,fetch_all
+from concurrent.futures import ProcessPoolExecutor
 from warnings import filterwarnings
 filterwarnings("ignore", message="numpy.dtype size changed")
 filterwarnings("ignore", message="numpy.ufunc size changed")
 
+metrics=Metrics('getweights')
+
 class Break(Exception):
     """Permits deep breaks."""
     def __str__(self):
         return "Break"
 
-def main():
+def month(dt,offset):
+    """The 28th of the month offset months from that of a date, stepping 29 days at a time."""
+    dt=datetime.strptime(dt.strftime("%Y%m28"),"%Y%m%d")
+
+    while offset>0:
+        dt-=timedelta(days=29)
+        dt=datetime.strptime(dt.strftime("%Y%m28"),"%Y%m%d")
+        offset-=1
+
+    return dt
+
+def periods(args):
+    """Periods to load, as YYYYMM: --period, or every month from --from to --to."""
+    if args.start==None:
+        return [args.period]
+
+    dt,end=datetime.strptime(args.start+"28","%Y%m%d"),datetime.strptime(args.end+"28","%Y%m%d")
+    result=[]
+
+    while dt<=end:
+        result.append(dt.strftime("%Y%m"))
+        dt=datetime.strptime((dt+timedelta(days=7)).strftime("%Y%m28"),"%Y%m%d")
+
+    return result
+
+def read_workbook(filename,args):
+    """Reference period and data rows (indent, category, weight or None) of a workbook, streamed from its sheet keeping
+    only the columns used; run in a process pool when backfilling, so it takes and returns only what pickles."""
+    label,rows=None,[]
+
+    for row,values in xlsx.rows(filename,args.sheet,[args.indent,args.category,args.weight]):
+        if row==args.label:
+            label=values.get(args.weight)
+
+        if row>=args.firstrow and isinstance(values.get(args.indent),float):
+            rows.append((
+                values[args.indent],
+                sub(r"\s*\(\d+\)\s*","",str(values.get(args.category,""))),
+                values.get(args.weight) if isinstance(values.get(args.weight),float) else None
+            ))
+
+    s=sub(r"[\r\n]+"," ",str(label or ""))
+    m=search(r"(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[.\s]+(\d+)",s)
+
+    if m==None:
+        raise ValueError("Cannot identify reference period in label string '%s' in Cell(%d,%d) of %s." % (s,args.label,args.weight,filename))
+
+    return datetime.strptime("%s %s 01" % m.group(1,2),"%b %Y %d"),rows
+
+def write_period(connection,execute,args,items,ids,dt,rows,since):
+    """Write the items, series and weights of a period in one transaction through execute(sql,params), closing the
+    intervals of history rows superseded by those above the watermark since, and returning the number of statements."""
+    print("Reference period:",dt.strftime("%YM%m"))
+    items={item:dict(data) for item,data in items.items()} # each period's hierarchy starts afresh
+    path,sseq=[],[]
+
+    for i,c,w in rows:
+        level=i+1
+
+        if level>len(path):
+            path.append(c)
+
+        else:
+            while level<=len(path):
+                path.pop()
+
+            path.append(c)
+
+        if c in items:
+            sseq.append(c)
+            items[c]['indent_level']=i
+            items[c]['value']=w
+            items[c]['sort_sequence']=sseq.index(c)+1
+
+            if i>0 and path[-2] in items:
+                items[c]['parent_id']=ids.get(items[path[-2]]['item_code'])
+                items[c]['parent']=path[-2]
+
+            else:
+                items[c]['parent_id'],items[c]['parent']=None,None
+
+    # children counted by parent here, so each item is written once with its count and a rerun gives the same
+    children={}
+
+    for data in items.values():
+        if data.get('parent')!=None and data['value']!=None:
+            children[data['parent']]=children.get(data['parent'],0)+1
+
+    print("Writing data.")
+    writer=Writer(connection)
+
+    for item,data in sorted(items.items(),key=lambda x:x[1]['sort_sequence']):
+        if 'indent_level' not in data:
+            continue
+
+        # items
+        fields={
+            'section':args.write,
+            'item_code':data['item_code'],
+            'item_name':data['item_name'],
+            'display_level':int(data['indent_level']),
+            'selectable':ord(data['selectable']) if isinstance(data['selectable'],bytes) else data['selectable'], # a bit column reads as bytes from MySQL
+            'sort_sequence':data['sort_sequence'],
+            'children':children.get(item,0)
+        }
+
+        if data['parent_id']!=None:
+            fields['parent_id']=data['parent_id']
+
+        writer.add('BLSItems',fields)
+
+        # series
+        fields={
+            'section':args.write,
+            'area_code':'0000',
+            'seasonal':'U',
+            'periodicity_code':'R',
+            'item_code':data['item_code'],
+        }
+
+        fields['series_id']="%2.2s%1.1s%1.1s%4.4s%s" % (
+            fields['section'],
+            fields['seasonal'],
+            fields['periodicity_code'],
+            fields['area_code'],
+            fields['item_code']
+        )
+
+        fields['series_title']="Relative importance of %s, not seasonally adjusted" % item
+        writer.add('BLSSeries',fields)
+
+        # write to BLSTimeSeries table
+        fields={
+            'series_id':fields['series_id'],
+            'date':dt.replace(day=monthrange(dt.year,dt.month)[1]).strftime("%Y-%m-%d"), # last day, computed here as not every backend has LAST_DAY()
+            'year':dt.year,
+            'period':dt.strftime("M%m"),
+            'value':data['value']
+        }
+
+        writer.add('BLSTimeSeries',fields)
+        writer.add('BLSTimeSeriesHistory',fields,False)
+
+        print("%3d %1d %8.8s %-8.8s %s" % (
+            data['sort_sequence'],
+            data['indent_level'],
+            ("%8.3f" % data['value']) if data['value']!=None else "",
+            data['item_code'],
+            (' '*int(data['indent_level']))+item
+        ))
+
+    # parents written in this period have no id above, so they are joined to by code once written, in the same
+    # transaction and one statement for all of them
+    pairs=[(data['item_code'],items[data['parent']]['item_code']) for data in items.values() if 'indent_level' in data and data['parent_id']==None and data.get('parent')!=None]
+
+    if len(pairs)>0:
+        codes=" UNION ALL ".join(["SELECT {0} AS item_code,{0} AS parent_code"]+["SELECT {0},{0}"]*(len(pairs)-1))
+
+        if isinstance(connection,Embedded):
+            sql="UPDATE BLSItems SET parent_id=parent.id FROM (%s) AS pairs JOIN BLSItems AS parent ON parent.item_code=pairs.parent_code WHERE BLSItems.section={0} AND parent.section=BLSItems.section AND pairs.item_code=BLSItems.item_code" % codes
+
+        else: # MySQL cannot read the table an UPDATE writes in a subquery, but can join it
+            sql="UPDATE BLSItems JOIN (%s) AS pairs ON pairs.item_code=BLSItems.item_code JOIN BLSItems AS parent ON parent.section=BLSItems.section AND parent.item_code=pairs.parent_code SET BLSItems.parent_id=parent.id WHERE BLSItems.section={0}" % codes
+
+        writer.execute(sql.format(placeholder(connection)),[code for pair in pairs for code in pair]+[args.write])
+
+    # revised weights supersede the history rows they were before, as fetch.py's loads do
+    writer.execute(close_intervals(connection,since))
+
+    # a new load generation, so readers drop anything they cached
+    writer.execute("INSERT INTO BLSLoads (sections) VALUES (%s)" % placeholder(connection),[args.write])
+
+    # the period in one transaction, in a handful of statements
+    return writer.write(execute)
+
+def main(argv=None):
     # arguments
     from argparse import ArgumentParser
     args=ArgumentParser();
@@ -29,6 +209,9 @@ def main():
     args.add_argument("-u","--url",type=str,default="https://www.bls.gov/cpi/tables/supplemental-files/news-release-table2-%s.xlsx",help="URL to get CPI worksheets.")
     args.add_argument("-p","--period",type=str,default=None,help="Period to download data for.")
     args.add_argument("-o","--offset",type=int,default=2,help="Periods to offset by.")
+    args.add_argument("--from",dest='start',type=str,default=None,help="First period of a range to backfill, as YYYYMM.")
+    args.add_argument("--to",dest='end',type=str,default=None,help="Last period of a range to backfill, as YYYYMM (defaults to --period).")
+    args.add_argument("-j","--jobs",type=int,default=8,help="Workbooks to download and to parse at once when backfilling.")
     args.add_argument("-f","--folder",type=str,default="/Users/%s/Dropbox/Data/BLS" % getenv("USER"),help="Folder for data storage.")
     args.add_argument("-s","--sheet",type=int,default=0,help="Worksheet index in Excel workbook.")
     args.add_argument("-r","--read",type=str,default='cu',help="Section of LABSTAT to read for items.")
@@ -40,20 +223,15 @@ def main():
     args.add_argument("-I","--indent",type=int,default=0,help="Data row for indent level (0 offset).")
     args.add_argument("-x","--warnings",action='store_true',help="Set to catch database warnings.")    
     args.add_argument("-n","--nodownload",action='store_true',help="Set to prevent downloads.")
-    args=args.parse_args();
+    args.add_argument("-M","--metrics",type=str,default=None,help="File to write the JSON run record of timed stages to.")
+    args.add_argument("-E","--prometheus",type=str,default=None,help="File to write run metrics to in the Prometheus textfile format.")
+    args=args.parse_args(argv);
     
     if args.period==None:
-        dt,om=datetime.strptime(datetime.now().strftime("%Y%m28"),"%Y%m%d"),args.offset
-        
-        while om>0:
-            dt-=timedelta(days=29)
-            dt=datetime.strptime(dt.strftime("%Y%m28"),"%Y%m%d")
-            om-=1
-            
-        args.period=dt.strftime("%Y%m")
-        
-    if "%s" in args.url:
-        args.url=args.url % args.period
+        args.period=month(datetime.now(),args.offset).strftime("%Y%m")
+
+    if args.start!=None and args.end==None:
+        args.end=args.period
 
     # initialize
     print(__doc__,"\nParameters:",vars(args) if not args.hidden else 'hidden')
@@ -62,229 +240,81 @@ def main():
         filterwarnings('ignore',category=Warning)
     
     # connect to database
-    database=dict(map(lambda x:x.split('='),args.database.split(';')))
-
-    if 'pwd' not in database or database['pwd']=='' or database['pwd']==None:
-        database['pwd']=getenv('MYSQLPASSWORD')
-
-    if database['pwd']==None or database['pwd']=='':
-        from getpass import getpass
-        database['pwd']=getpass('Database password:')
-
-    if 'server' not in database or database['server']=='' or database['server']==None:
-        database['server']='localhost'
-
-    print("Connecting to database %s." % (database['server'] if not args.hidden else 'hidden'))
-
-    connection=connect(
-        db=database['database'] if 'database' in database else 'mysql',
-        host=database['server'] if 'server' in database else 'localhost',
-        port=int(database['port']) if 'port' in database else 3306,
-        user=database['uid'] if 'uid' in database else getenv('USER'),
-        password=database['pwd'],
-        cursorclass=DictCursor,
-        autocommit=True
-    )
+    database=parse(args.database,args.hidden)
+    metrics.start()
+    connection=connect(database)
 
     # main code
     try:
         with connection.cursor() as cursor:
             # read BLSItems for cu section
             items,sql={},"SELECT * FROM BLSItems WHERE section='%s'" % args.read
-            cursor.execute(sql)
+            metrics.execute(cursor,sql)
             
             for row in cursor.fetchall():
                 items[row['item_name']]=row
                 
             print("Found %d items in section '%s'." % (len(items),args.read))
+
+            # ids of the items already written by item code, so parents are found without a query each
+            sql="SELECT id,item_code FROM BLSItems WHERE section='%s'" % args.write
+            metrics.execute(cursor,sql)
+            ids={row['item_code']:row['id'] for row in cursor.fetchall()}
             
-            # download the data
-            filename="%s/%s" % (args.folder,args.url.split("/")[-1])
+            # download the data, several workbooks at once when backfilling
+            urls=[args.url % period if "%s" in args.url else args.url for period in periods(args)]
+            filenames=["%s/%s" % (args.folder,url.split("/")[-1]) for url in urls]
 
             if not args.nodownload:
-                print("Fetching data file from:",args.url)
-                response=get(args.url)
+                print("Fetching %d data files from:" % len(urls),args.url)
+
+                found=[]
+
+                for url,filename,response in zip(urls,filenames,fetch_all(urls,args.jobs)):
+                    metrics.record('download',file=url.split("/")[-1],status=str(response.status_code),bytes=len(response.content),seconds=response.elapsed.total_seconds())
 
-                if response.status_code/100!=2:
-                    raise ValueError("Status code %d returned for URL %s" % (response.status_code,args.url))
+                    if response.status_code==404 and len(urls)>1: # not every month of a range was published
+                        print("No data file at %s, skipping." % url)
+                        continue
 
-                print("Writing data to %s" % filename)
+                    if response.status_code/100!=2:
+                        raise ValueError("Status code %d returned for URL %s" % (response.status_code,url))
 
-                with open(filename,"wb") as datafile:
-                    for chunk in response.iter_content():
-                        datafile.write(chunk)
+                    print("Writing data to %s" % filename)
 
-                    chmod(datafile.name,0o644) # change file permissions  
+                    with open(filename,"wb") as datafile:
+                        datafile.write(response.content)
+                        chmod(datafile.name,0o644) # change file permissions  
+
+                    found.append(filename)
+
+                filenames=found
                 
             if args.update:
-               # process the data
-                print("Reading data from local cached copy.")
-            
-                with open_workbook(filename,"r") as workbook:
-                    worksheet=workbook.sheets()[args.sheet]
-                    nr,nc=worksheet.nrows,worksheet.ncols                 
-                    print("Sheet is %d rows by %d columns." % (nr,nc))
-                    s=sub(r"[\r\n]+"," ",worksheet.cell(args.label,args.weight).value)
-                    m=search(r"(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[.\s]+(\d+)",s)
-                    
-                    if m!=None:
-                        dt=datetime.strptime("%s %s 01" % m.group(1,2),"%b %Y %d")
-                    
-                    else:
-                        raise ValueError("Cannot identify reference period in label string '%s' in Cell(%d,%d)." % (s,args.label,args.weight))
-                
-                    print("Reference period:",dt.strftime("%YM%m"))
-                    
-                    path,sseq=[],[]
-                    
-                    for row in range(args.firstrow,nr):
-                        if worksheet.cell(row,args.indent).ctype==2:
-                            i=worksheet.cell(row,args.indent).value
-                            c=sub(r"\s*\(\d+\)\s*","",worksheet.cell(row,args.category).value)
-                            w=worksheet.cell(row,args.weight).value
-                            level=i+1
-
-                            if level>len(path):
-                                path.append(c)
-
-                            else:
-                                while level<=len(path):
-                                    path.pop()
-
-                                path.append(c)
-                            
-                            if c in items:
-                                sseq.append(c)
-                                items[c]['indent_level']=i
-                                items[c]['value']=w if worksheet.cell(row,args.weight).ctype==2 else None                               
-                                items[c]['sort_sequence']=sseq.index(c)+1
-
-                                if i>0 and path[-2] in items:
-                                    sql="SELECT * FROM BLSItems WHERE section='%s' AND item_code='%s'" % (
-                                        args.write,
-                                        items[path[-2]]['item_code']
-                                    )
-                                                                        
-                                    cursor.execute(sql)
-                                    
-                                    for row in cursor.fetchall():
-                                        items[c]['parent_id']=row['id']
-                                
-                                else:
-                                    items[c]['parent_id']=None
-                                
-                    print("Writing data.")
-                    
-                    for item,data in sorted(items.items(),key=lambda x:x[1]['sort_sequence']): 
-                        if 'indent_level' not in data:
-                            continue
-                            
-                        # items 
-                        fields={
-                            'section':"'%s'" % args.write,
-                            'item_code':"'%s'" % data['item_code'],
-                            'item_name':"'%s'" % data['item_name'].replace("'","''"),
-                            'display_level':str(data['indent_level']),
-                            'selectable':str(ord(data['selectable'])),
-                            'sort_sequence':str(data['sort_sequence']),
-                            'children':'0'
-                        }
-                                                
-                        if data['parent_id']!=None:
-                            fields['parent_id']=str(data['parent_id'])
-                                                
-                        sql="/* Writing data to '%s' section of BLSItems table */ INSERT INTO BLSItems (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (
-                            args.write, # this is encoded as a comment for debugging purposes
-                            ",".join(fields.keys()),
-                            ",".join(fields.values()),
-                            ",".join(map(lambda x:"%s=%s" % x,fields.items()))
-                        )
-
-                        if args.update:
-                            cursor.execute(sql) 
-
-                        else:
-                            print(sql)
-                            
-                        if data['parent_id']!=None and data['value']!=None:    
-                            sql="UPDATE BLSItems SET children=children+1 WHERE id=%s" % fields['parent_id']
-                        
-                            if args.update:
-                                cursor.execute(sql) 
-
-                            else:
-                                print(sql)
-
-                        # series
-                        fields={
-                            'section':"'%s'" % args.write,
-                            'area_code':"'0000'",
-                            'seasonal':"'U'",
-                            'periodicity_code':"'R'",
-                            'item_code':"'%s'" % data['item_code'],
-                        }
-                        
-                        fields['series_id']="'%2.2s%1.1s%1.1s%4.4s%s'" % (
-                            fields['section'].replace("'",""),
-                            fields['seasonal'].replace("'",""),
-                            fields['periodicity_code'].replace("'",""),
-                            fields['area_code'].replace("'",""),
-                            fields['item_code'].replace("'","")
-                        )
-                        
-                        fields['series_title']="'Relative importance of %s, not seasonally adjusted'" % item.replace("'","''")                            
-                        sql="/* Writing data to '%s' section of BLSSeries table */ INSERT INTO BLSSeries (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (
-                            args.write, # this is encoded as a comment for debugging purposes
-                            ",".join(fields.keys()),
-                            ",".join(fields.values()),
-                            ",".join(map(lambda x:"%s=%s" % x,fields.items()))
-                        )
-
-                        if args.update:
-                            cursor.execute(sql) 
-
-                        else:
-                            print(sql)
-                            
-                        # write to BLSTimeSeries table 
-                        fields={
-                            'series_id':fields['series_id'],
-                            'date':dt.strftime("LAST_DAY('%Y-%m-%d')"),
-                            'year':dt.strftime("'%Y'"),
-                            'period':dt.strftime("'M%m'"),
-                            'value':str(data['value']) if data['value']!=None else 'NULL'
-                        }
-
-                        sql="/* Writing data to BLSTimeSeries table */ INSERT INTO BLSTimeSeries (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (
-                            ",".join(fields.keys()),
-                            ",".join(fields.values()),
-                            ",".join(map(lambda x:"%s=%s" % x,fields.items()))
-                        )
-
-                        if args.update:
-                            cursor.execute(sql) 
-
-                        else:
-                            print(sql)
-                            
-                        sql="/* Writing data to BLSTimeSeriesHistory table */ INSERT IGNORE INTO BLSTimeSeriesHistory (%s) VALUES (%s)" % (
-                            ",".join(fields.keys()),
-                            ",".join(fields.values())
-                        )
-
-                        if args.update:
-                            cursor.execute(sql) 
-
-                        else:
-                            print(sql)
-
-                        print("%3d %1d %8.8s %-8.8s %s" % (
-                            data['sort_sequence'],
-                            data['indent_level'],
-                            ("%8.3f" % data['value']) if data['value']!=None else "",
-                            data['item_code'],
-                            (' '*int(data['indent_level']))+item
-                        ))
+                # process the data, parsing workbooks in a pool of processes and writing them in period order
+                print("Reading data from %d local cached copies." % len(filenames))
+
+                def execute(statement,params):
+                    nonlocal sql
+                    sql=statement
+                    metrics.execute(cursor,sql,params)
+
+                with ProcessPoolExecutor(max_workers=max(1,min(args.jobs,len(filenames)))) as parsers:
+                    for filename,(dt,rows) in zip(filenames,(parsers.map if len(filenames)>1 else map)(read_workbook,filenames,[args]*len(filenames))):
+                        # the latest history row before the period, so its revisions close the intervals they supersede
+                        sql="SELECT MAX(id) AS id FROM BLSTimeSeriesHistory"
+                        metrics.execute(cursor,sql)
+                        since=cursor.fetchone()['id'] or 0
+
+                        with metrics.timed('write',file=filename.split("/")[-1]) as entry:
+                            entry['statements']=write_period(connection,execute,args,items,ids,dt,rows,since)
+                            print("Wrote the period in %d statements." % entry['statements'])
+
+                        # ids again, so items first written for this period are parents in the next
+                        if len(filenames)>1:
+                            sql="SELECT id,item_code FROM BLSItems WHERE section='%s'" % args.write
+                            metrics.execute(cursor,sql)
+                            ids={row['item_code']:row['id'] for row in cursor.fetchall()}
  
     except (DatabaseError,OperationalError) as e:
         if 'sql' in locals():
@@ -296,6 +326,10 @@ def main():
         stdout.flush()
         stderr.write('Interrupted.\n')
 
+    finally:
+        release(database,connection)
+        metrics.write(args.metrics,args.prometheus,int(exc_info()[0]!=None))
+
     # done
     print("Done.")
 
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Library to read LABSTAT time series back out of the database as NumPy arrays.
+
+    from labstat import read_series, history, frame
+    series=read_series(['CUUR0000SA0','CUUR0000SAF1'],'2020-01-01','2024-12-31') # {series_id: (dates, values)}
+    dates,values=frame(['CUUR0000SA0','CUUR0000SAF1'],'2020-01-01') # values[date, series], NaN where missing
+    vintages=history(['CUUR0000SA0'],['2024-01-15','2024-02-15']) # {capture time: {series_id: (dates, values)}}, as published then
+"""
+
+# modules
+from pymysql.cursors import SSCursor
+from numpy import array,full,union1d,searchsorted,nan
+from collections import OrderedDict
+from threading import Lock
+from re import match
+from os import getenv
+from backends import connect,Embedded
+from connections import parse
+
+class Reader:
+    """Reads many series in one query over an unbuffered cursor, with an LRU cache in front of it. The cache is emptied
+    whenever the load generation, the latest id in BLSLoads that fetch.py and getweights.py add to, has moved on."""
+    def __init__(self,database,size=1024,batch=10000):
+        self.connection,self.size,self.batch=connect(database),size,batch
+        self.cache,self.lock,self.generation=OrderedDict(),Lock(),None
+
+    def stream(self,sql):
+        """Yield the rows of a query as tuples without buffering the whole result on the client, where the backend can."""
+        cursor=self.connection.connection.cursor() if isinstance(self.connection,Embedded) else self.connection.cursor(SSCursor)
+
+        try:
+            cursor.execute(sql)
+
+            while True:
+                rows=cursor.fetchmany(self.batch)
+
+                if len(rows)==0:
+                    break
+
+                yield from rows
+
+        finally:
+            cursor.close()
+
+    def invalidate(self):
+        """Empty the cache if there has been a load since it was filled."""
+        generation=list(self.stream("SELECT MAX(id) FROM BLSLoads"))[0][0]
+
+        if generation!=self.generation:
+            self.cache.clear()
+            self.generation=generation
+
+    def timestamp(self,as_of):
+        """SQL for a capture time that compares as a time with the captured and valid_to columns of each backend."""
+        if not isinstance(self.connection,Embedded):
+            return "CAST('%s' AS DATETIME)" % as_of
+
+        return "CAST('%s' AS TIMESTAMP)" % as_of if self.connection.kind=='duckdb' else "'%s'" % as_of # SQLite compares ISO strings
+
+    def query(self,missing,start,end):
+        """One statement reading the series missing for each capture time, None for the current values: those from
+        BLSTimeSeries, and those as of every other time from BLSTimeSeriesHistory by joining the times to the rows valid
+        at them, so any number of vintages is a single set-based pass over the history."""
+        dates="%s%s" % (" AND date>='%s'" % start if start!=None else ''," AND date<='%s'" % end if end!=None else '')
+        selects=[]
+
+        if None in missing:
+            selects.append("SELECT NULL AS as_of,series_id,date,value FROM BLSTimeSeries WHERE series_id IN (%s) AND date IS NOT NULL%s" % (
+                ",".join(map(lambda x:"'%s'" % x,missing[None])),
+                dates
+            ))
+
+        times=[as_of for as_of in missing if as_of!=None]
+
+        if len(times)>0:
+            selects.append("""SELECT vintages.as_of,series_id,date,value FROM (%s) AS vintages JOIN BLSTimeSeriesHistory ON captured<=vintages.at AND (valid_to IS NULL OR valid_to>vintages.at) WHERE series_id IN (%s) AND date IS NOT NULL%s""" % (
+                " UNION ALL ".join(map(lambda x:"SELECT '%s' AS as_of,%s AS at" % (x,self.timestamp(x)),times)),
+                ",".join(map(lambda x:"'%s'" % x,dict.fromkeys(series_id for as_of in times for series_id in missing[as_of]))),
+                dates
+            ))
+
+        return "%s ORDER BY as_of,series_id,date" % " UNION ALL ".join(selects)
+
+    def history(self,ids,times,start=None,end=None):
+        """Dates (datetime64[D]) and values (float64, NaN for NULL) of each series between two dates as published at
+        each of several capture times ('YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS', or None for the current values), in one
+        query for all those not already cached. Returns a dict by time of dicts by series id; series without data then
+        have empty arrays. A value is as of a time from when it was captured until a revision superseded it."""
+        for series_id in ids:
+            if match(r'^\w+%?\w*$',series_id)==None: # a % in the section of those getweights.py writes, e.g. W%UR0000SA0
+                raise ValueError("Not a LABSTAT series id: '%s'." % series_id)
+
+        for date in [start,end]:
+            if date!=None and match(r'^\d{4}-\d{2}-\d{2}$',str(date))==None:
+                raise ValueError("Not a date: '%s'." % date)
+
+        for as_of in times:
+            if as_of!=None and match(r'^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}(:\d{2})?)?$',str(as_of))==None:
+                raise ValueError("Not a capture time: '%s'." % as_of)
+
+        times=[as_of if as_of==None else str(as_of) for as_of in dict.fromkeys(times)] # in order, without repeats
+
+        with self.lock:
+            self.invalidate()
+            result,missing={as_of:{} for as_of in times},{}
+
+            for as_of in times:
+                for series_id in dict.fromkeys(ids):
+                    key=(series_id,start and str(start),end and str(end),as_of)
+
+                    if key in self.cache:
+                        self.cache.move_to_end(key)
+                        result[as_of][series_id]=self.cache[key]
+
+                    else:
+                        missing.setdefault(as_of,[]).append(series_id)
+
+            if len(missing)>0:
+                rows={(as_of,series_id):([],[]) for as_of in missing for series_id in missing[as_of]}
+
+                for as_of,series_id,date,value in self.stream(self.query(missing,start,end)):
+                    if (as_of,series_id) in rows: # the history part reads every series missing at any time
+                        rows[as_of,series_id][0].append(str(date)) # a date from MySQL, an ISO string from SQLite
+                        rows[as_of,series_id][1].append(nan if value==None else float(value))
+
+                for (as_of,series_id),(dates,values) in rows.items():
+                    result[as_of][series_id]=(array(dates,dtype='datetime64[D]'),array(values,dtype=float))
+                    self.cache[(series_id,start and str(start),end and str(end),as_of)]=result[as_of][series_id]
+
+                while len(self.cache)>self.size:
+                    self.cache.popitem(last=False)
+
+            return {as_of:{series_id:result[as_of][series_id] for series_id in dict.fromkeys(ids)} for as_of in times}
+
+    def read_series(self,ids,start=None,end=None,as_of=None):
+        """Dates (datetime64[D]) and values (float64, NaN for NULL) of each series between two dates, in one query for
+        all the series not already cached, as published at a capture time if given. Returns a dict by series id; series
+        without data have empty arrays."""
+        return list(self.history(ids,[as_of],start,end).values())[0]
+
+    def frame(self,ids,start=None,end=None,as_of=None):
+        """Series as a wide frame: the union of their dates, and a 2-d array of values by date and series, NaN filled."""
+        series=self.read_series(ids,start,end,as_of)
+        dates=array([],dtype='datetime64[D]')
+
+        for d,v in series.values():
+            dates=union1d(dates,d)
+
+        values=full((len(dates),len(series)),nan)
+
+        for n,(d,v) in enumerate(series.values()):
+            values[searchsorted(dates,d),n]=v
+
+        return dates,values
+
+    def close(self):
+        self.connection.close()
+
+reader=None
+
+def default():
+    """Reader for the database named by $LABSTAT_DATABASE, in the --database format of the scripts."""
+    global reader
+
+    if reader==None:
+        reader=Reader(parse(getenv('LABSTAT_DATABASE','database=Analysis'),True))
+
+    return reader
+
+def read_series(ids,start=None,end=None,as_of=None):
+    """Read series with the default reader; see Reader.read_series."""
+    return default().read_series(ids,start,end,as_of)
+
+def history(ids,times,start=None,end=None):
+    """Read series as of several capture times with the default reader; see Reader.history."""
+    return default().history(ids,times,start,end)
+
+def frame(ids,start=None,end=None,as_of=None):
+    """Read series as a wide frame with the default reader; see Reader.frame."""
+    return default().frame(ids,start,end,as_of)
@@ -1,15 +1,19 @@
 #!/bin/zsh
 python=/Users/alexcastro/anaconda3/envs/labor-statistics/bin/python
 dir=/Users/alexcastro/Development/Labor-Statistics
-series=${dir}/src/fetch.py
-weights=${dir}/src/getweights.py
+runner=${dir}/src/runner.py
+runs=${dir}/runs # JSON run records and Prometheus textfiles
+vintages=${dir}/vintages # compressed vintages of every file downloaded, see vintages.py
+mkdir -p "$runs"
 
-for section in ap cu su
-do
-    echo `date`: fetching data for $section
-    $python "$series" --update --local $section || exit $?
-done
-
-$python "$weights" --update --weight=2
+# one process for every step, sharing database connections and the HTTP session; every step runs even if an earlier one
+# failed, a failed fetch is retried once with --resume, and the job exits with the last failure
+echo `date`: fetching data for ap cu su, weights, and exporting changed partitions to Parquet
+$python "$runner" --wait=60 \
+    "fetch --update --local --archive='$vintages' --metrics='$runs/fetch.json' --prometheus='$runs/fetch.prom' ap cu su" \
+    "getweights --update --weight=2 --metrics='$runs/getweights.json' --prometheus='$runs/getweights.prom'" \
+    "export"
+failed=$?
 
 echo `date`: Done.
+exit $failed
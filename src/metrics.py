@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Run records of the scripts: timed stages written as JSON and, optionally, as a Prometheus textfile."""
+
+# modules
+from time import time
+from datetime import datetime
+from threading import local,Lock
+from contextlib import contextmanager
+from json import dump
+from os import replace
+from re import sub,search,findall
+
+def warnings(cursor):
+    """Warnings raised by a cursor's last statement, as counted by the server (what SHOW COUNT(*) WARNINGS reports)."""
+    result=getattr(cursor,'_result',None) # pymysql keeps the last result's OK packet counts here
+
+    return getattr(result,'warning_count',0) if result!=None else 0
+
+def statement(sql):
+    """Short label for a statement: its leading /* comment */, or else its first three words."""
+    m=search(r'^\s*/\*\s*(.*?)\s*\*/',sql)
+
+    return sub(r'\s+',' ',m.group(1)) if m!=None else " ".join(findall(r'\w+',sql)[:3])
+
+class Metrics:
+    """Records of a run's stages, each of a metric with labels (strings) and measurements (numbers). Labels given to
+    context() apply to everything recorded inside it by the same thread, so worker threads keep their section."""
+    def __init__(self,script):
+        self.script,self.lock,self.local=script,Lock(),local()
+        self.start()
+
+    def start(self):
+        """Start a new run, for scripts run more than once in a process by runner.py."""
+        self.started,self.records=time(),[]
+
+    @contextmanager
+    def context(self,**labels):
+        previous=getattr(self.local,'labels',{})
+        self.local.labels=dict(previous,**labels)
+
+        try:
+            yield
+
+        finally:
+            self.local.labels=previous
+
+    def record(self,metric,**fields):
+        entry=dict(getattr(self.local,'labels',{}),metric=metric,at=round(time()-self.started,3),**fields)
+
+        with self.lock:
+            self.records.append(entry)
+
+        return entry
+
+    @contextmanager
+    def timed(self,metric,**fields):
+        """Time a block, yielding its record so measurements can be added to it; a failure is recorded too."""
+        started,entry=time(),dict(fields)
+
+        try:
+            yield entry
+
+        except Exception as e:
+            entry['error']=str(e).split('\n')[0]
+            raise
+
+        finally:
+            self.record(metric,seconds=round(time()-started,6),**entry)
+
+    def execute(self,cursor,sql,params=None,**fields):
+        """Execute a statement, with parameters if given, recording its time, rows affected and warnings. Rows are not
+        recorded when the driver does not know them (-1 from SQLite and DuckDB, for a SELECT say)."""
+        with self.timed('sql',statement=statement(sql),**fields) as entry:
+            rows=cursor.execute(sql,params)
+            entry['rows']=rows if isinstance(rows,int) and rows>=0 else None
+            entry['warnings']=warnings(cursor)
+
+        return rows
+
+    def write(self,filename=None,textfile=None,status=0):
+        """Write the run record as JSON and the totals of each measurement by metric and labels as a Prometheus textfile."""
+        finished=time()
+        run={
+            'script':self.script,
+            'started':datetime.fromtimestamp(self.started).isoformat(),
+            'seconds':round(finished-self.started,3),
+            'status':status,
+            'records':self.records,
+        }
+
+        if filename!=None:
+            with open(filename+".tmp","w") as jsonfile:
+                dump(run,jsonfile,indent=2,default=str)
+
+            replace(filename+".tmp",filename) # atomic, so a collector never reads a torn file
+
+        if textfile!=None:
+            totals={}
+
+            for entry in self.records:
+                labels=tuple(sorted((k,v) for k,v in entry.items() if isinstance(v,str) and k not in ['metric','error']))
+
+                for k,v in entry.items():
+                    if isinstance(v,(int,float)) and not isinstance(v,bool) and k!='at':
+                        name="labstat_%s_%s" % (entry['metric'],k)
+                        totals[name,labels]=totals.get((name,labels),0)+v
+
+                if 'error' in entry:
+                    totals["labstat_%s_errors" % entry['metric'],labels]=totals.get(("labstat_%s_errors" % entry['metric'],labels),0)+1
+
+            totals["labstat_run_seconds",()]=finished-self.started
+            totals["labstat_run_status",()]=status
+            totals["labstat_run_finished_timestamp_seconds",()]=finished
+
+            with open(textfile+".tmp","w") as promfile:
+                for (name,labels),value in sorted(totals.items()):
+                    promfile.write("%s{%s} %s\n" % (
+                        name,
+                        ",".join(['script="%s"' % self.script]+['%s="%s"' % (k,v.replace('\\','\\\\').replace('"','\\"')) for k,v in labels]),
+                        repr(float(value))
+                    ))
+
+            replace(textfile+".tmp",textfile)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Pre-normalization of LABSTAT files into clean tab separated files that LOAD DATA can read with a plain column list."""
+
+# modules
+from numpy import array,char,where,select,full,maximum,datetime64,isin,vectorize
+from re import sub
+from operator import methodcaller
+from sections import columns as layout
+
+# columns of the clean files, in the order they are written
+COLUMNS={
+    'items':['section','item_code','item_name','display_level','selectable','sort_sequence'],
+    'series':['section','series_id','area_code','item_code','seasonal','periodicity_code','base_code','base_period','series_title','footnote_codes','begin_year','begin_period','end_year','end_period','begin_date','end_date'],
+    'data':['series_id','year','period','value','footnote_codes','date'],
+}
+
+NULL=r'\N'
+
+def blocks(filename,column,ignore,width,blocksize):
+    """Yield blocks of rows of a raw file as lists of width columns, each an array of trimmed strings only as wide as its
+    own longest value, so a long title does not widen every other column."""
+    with open(filename,newline='',encoding='latin-1') as rawfile:
+        for n in range(ignore):
+            rawfile.readline()
+
+        while True:
+            text=rawfile.read(blocksize)+rawfile.readline() # whole lines only
+
+            if len(text)==0:
+                break
+
+            lines=text.replace('\r\n','\n').split('\n')[:-1 if text.endswith('\n') else None]
+            del text
+
+            if set(map(methodcaller('count',column),lines))=={width-1}: # every row complete, so split them all at once
+                fields=column.join(lines).split(column)
+                del lines
+                yield [char.strip(array(fields[n::width],dtype=str)) for n in range(width)]
+
+            else:
+                rows=[(line.rstrip('\r').split(column)+['']*width)[:width] for line in lines]
+                del lines
+                yield [char.strip(array(values,dtype=str)) for values in zip(*rows)]
+
+def integers(values):
+    """Integer array with 0 for blanks."""
+    return where(values=='','0',values).astype(int)
+
+def month_ends(years,months):
+    """Last day of each (year, month)."""
+    return ((years-1970)*12+months).astype('datetime64[M]').astype('datetime64[D]')-1
+
+def month_starts(years,months):
+    """First day of each (year, month)."""
+    return ((years-1970)*12+months-1).astype('datetime64[M]').astype('datetime64[D]')
+
+def days(years,mmdd):
+    """A fixed day of each year."""
+    return month_starts(maximum(years,1),int(mmdd[:2]))+(int(mmdd[3:])-1)
+
+def months(periods):
+    """Month number of monthly period codes, 0 for anything else or M13."""
+    monthly=(char.str_len(periods)==3)&(char.startswith(periods,'M'))&(periods!='M13')
+    return where(monthly,integers(char.lstrip(where(monthly,periods,'M0'),'M')),0)
+
+def dates(values):
+    """Strings for a date array with NULL for NaT."""
+    return where(values==datetime64('NaT'),NULL,values.astype(str))
+
+def nulls(values):
+    """Strings with NULL for blanks."""
+    return where(values=='',NULL,values)
+
+def data(fields):
+    """Clean columns from a block of a time series file."""
+    years,periods,values=integers(fields['year']),fields['period'],fields['value']
+    month,nat=months(periods),datetime64('NaT','D')
+    date=select(
+        [
+            (years>0)&(month>0),
+            (years>0)&(periods=='S01'),
+            (years>0)&isin(periods,['M13','S02','S03']),
+        ],
+        [
+            month_ends(years,where(month>0,month,1)),
+            days(years,'06-30'),
+            days(years,'12-31'),
+        ],
+        nat
+    )
+    return {
+        'series_id':fields['series_id'],
+        'year':nulls(fields['year']),
+        'period':nulls(periods),
+        'value':where((values=='')|(values=='-'),NULL,values),
+        'footnote_codes':nulls(fields['footnote_codes']),
+        'date':dates(date),
+    }
+
+def series(fields,section):
+    """Clean columns from a block of a series file."""
+    by,bp,ey,ep=integers(fields['begin_year']),fields['begin_period'],integers(fields['end_year']),fields['end_period']
+    bm,em,nat=months(bp),months(ep),datetime64('NaT','D')
+    begin=select(
+        [
+            (by>0)&(bm>0),
+            (by>0)&isin(bp,['S01','M13','S03']),
+            (by>0)&(bp=='S02'),
+        ],
+        [
+            month_starts(by,where(bm>0,bm,1)),
+            days(by,'01-01'),
+            days(by,'07-01'),
+        ],
+        nat
+    )
+    end=select( # semiannual end dates are taken from the begin year, as the SQL load always has
+        [
+            (ey>0)&(em>0),
+            (ey>0)&(ep=='S01')&(by>0),
+            (ey>0)&(ep=='S02')&(by>0),
+            (by>0)&isin(bp,['M13','S03']),
+        ],
+        [
+            month_ends(ey,where(em>0,em,1)),
+            days(by,'06-30'),
+            days(by,'12-31'),
+            days(by,'12-31'),
+        ],
+        nat
+    )
+    blank=full(len(by),NULL)
+    columns={
+        'section':full(len(by),section),
+        'series_id':fields['series_id'],
+        'begin_year':nulls(fields['begin_year']),
+        'begin_period':nulls(bp),
+        'end_year':nulls(fields['end_year']),
+        'end_period':nulls(ep),
+        'begin_date':dates(begin),
+        'end_date':dates(end),
+    }
+
+    for column in ['area_code','item_code','series_title']:
+        columns[column]=fields[column] if column in fields else blank
+
+    for column in ['seasonal','periodicity_code','base_code','base_period','footnote_codes']:
+        columns[column]=nulls(fields[column]) if column in fields else blank
+
+    if 'seasonal' not in fields and 'series_title' in fields: # derive it from the title
+        columns['seasonal']=where(char.find(char.lower(fields['series_title']),'not seasonally adjusted')>=0,'U','S')
+
+    return columns
+
+def items(fields,section):
+    """Clean columns from a block of an items file."""
+    blank=full(len(fields['item_code']),NULL)
+    columns={
+        'section':full(len(fields['item_code']),section),
+        'item_code':fields['item_code'],
+        'item_name':vectorize(lambda x:sub(r'\s+',' ',x),otypes=[str])(fields['item_name']),
+    }
+
+    for column in ['display_level','sort_sequence']:
+        columns[column]=nulls(fields[column]) if column in fields else blank
+
+    columns['selectable']=select([fields['selectable']=='T',fields['selectable']=='F'],['1','0'],NULL) if 'selectable' in fields else blank
+    return columns
+
+def normalize(kind,section,source,target,column='\t',ignore=1,blocksize=1<<20):
+    """Normalize a raw LABSTAT file into a clean file with the COLUMNS of its kind, returning the number of rows written.
+
+    The file is processed a block of about blocksize bytes at a time, a column at a time, and written a row at a time,
+    so memory use is bounded by the block. Blank rows are dropped."""
+    names,count=layout(section,kind),0
+
+    for block in blocks(source,column,ignore,len(names),blocksize):
+        kept=block[0]!='' # blank rows
+
+        if not kept.all():
+            block=[values[kept] for values in block]
+
+        if len(block[0])==0:
+            continue
+
+        fields=dict(zip(names,block))
+        columns=data(fields) if kind=='data' else series(fields,section) if kind=='series' else items(fields,section)
+        del block,fields
+        target.writelines(map(lambda row:"\t".join(row)+"\n",zip(*[columns.pop(name).tolist() for name in COLUMNS[kind]])))
+        count+=len(kept.nonzero()[0])
+
+    target.flush()
+    return count
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Script to run a job of several steps, each a script with its arguments, in one process.
+
+    runner.py "fetch --update --local ap cu su" "getweights --update --weight=2" "export"
+
+Interpreter startup and imports are paid once, and the steps share the pool of database connections and the HTTP
+session, so connections and TLS sessions made by one step are reused by the next."""
+
+# modules
+from sys import stderr,stdout,version_info,exit
+from time import sleep
+from datetime import datetime
+from importlib import import_module
+from shlex import split
+from traceback import print_exc
+import connections
+
+# scripts that can be run as steps, and those that can carry on from a failed run with --resume
+SCRIPTS=['fetch','getweights','getcategories','export']
+RESUMABLE=['fetch']
+
+def run(script,argv):
+    """Run a script's main() with arguments, returning its exit status rather than raising."""
+    try:
+        return import_module(script).main(argv) or 0
+
+    except SystemExit as e: # from argparse
+        return e.code if isinstance(e.code,int) else 1
+
+    except Exception:
+        stdout.flush()
+        print_exc()
+        return 1
+
+def main(argv=None):
+    # arguments
+    from argparse import ArgumentParser
+    args=ArgumentParser();
+    args.add_argument("step",type=str,nargs='+',help="Steps to run in order, each a script (%s) and its arguments." % ", ".join(SCRIPTS))
+    args.add_argument("-r","--retries",type=int,default=1,help="Times to retry a failed step with --resume, for scripts that can resume.")
+    args.add_argument("-w","--wait",type=int,default=60,help="Seconds to wait before retrying a failed step.")
+    args=args.parse_args(argv);
+
+    # initialize
+    steps=[split(step) for step in args.step]
+
+    for step in steps:
+        if step[0] not in SCRIPTS:
+            raise ValueError("Unknown script '%s' in step: %s" % (step[0]," ".join(step)))
+
+    connections.pool.keep=True # so steps reuse each other's connections
+    status=0 # every step runs even if an earlier one failed, and the job exits with the last failure
+
+    # main code
+    try:
+        for script,*argv in steps:
+            print("%s: running %s" % (datetime.now().ctime()," ".join([script]+argv)))
+            failed=run(script,argv)
+
+            for attempt in range(args.retries if script in RESUMABLE else 0):
+                if failed==0:
+                    break
+
+                print("%s: retrying the steps of %s that failed" % (datetime.now().ctime(),script))
+                sleep(args.wait)
+                failed=run(script,argv+['--resume'])
+
+            if failed!=0:
+                stdout.flush()
+                stderr.write("Step %s failed with status %d.\n" % (script,failed))
+                status=failed
+
+    finally:
+        connections.pool.close()
+
+    # done
+    print("%s: Done." % datetime.now().ctime())
+    return status
+
+# bootstrap
+if __name__ == "__main__":
+    assert(version_info.major>=3)
+    exit(main())
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Script to poll LABSTAT for new files around each section's expected releases and load a section as soon as it changes.
+
+    scheduler.py --fetch="--update --local" --after="cu:getweights --update --weight=2" --after="*:export" ap cu su
+
+Within a release window, from the release time on each expected day (see the section registry) for --window hours, the
+section's files are polled every --fast seconds; outside them every --slow seconds, to catch unscheduled revisions. A load
+that fails in a window is retried after --fast seconds, doubling with each further failure up to the window's end. A poll
+is a conditional HEAD of each file against the validators fetch.py recorded when it last loaded it, so an unchanged file
+costs a 304 and no download. When a file changes, fetch.py runs for that section alone and then the steps --after it, in
+this process, as runner.py runs them."""
+
+# modules
+from sys import stderr,stdout,version_info,exit
+from os import getenv
+from time import time,sleep
+from datetime import datetime,timedelta
+from zoneinfo import ZoneInfo
+from argparse import Namespace
+from shlex import split
+from sections import SECTIONS,release_day
+from connections import fetch_all,identity
+from metrics import Metrics
+import connections
+import runner
+
+metrics=Metrics('scheduler')
+
+def window(args,section,now):
+    """Start and end of the release window a section is in at a time, or else of its next one."""
+    hour,minute=map(int,args.time.split(':'))
+    day=now.astimezone(ZoneInfo(args.zone)).date()-timedelta(days=1) # a window may run on from the day before
+
+    for n in range(62):
+        if release_day(section,day+timedelta(days=n)):
+            start=datetime.combine(day+timedelta(days=n),datetime.min.time().replace(hour=hour,minute=minute),ZoneInfo(args.zone))
+
+            if start+timedelta(hours=args.window)>now:
+                return start,start+timedelta(hours=args.window)
+
+    raise ValueError("No release expected for LABSTAT section '%s' in the next two months." % section)
+
+def validators(entry):
+    """Headers making a request conditional on a file having changed since a cache entry."""
+    headers={}
+
+    if entry!=None and entry.get('etag'):
+        headers['If-None-Match']=entry['etag']
+
+    if entry!=None and entry.get('last_modified'):
+        headers['If-Modified-Since']=entry['last_modified']
+
+    return headers
+
+def poll(args,cache,section):
+    """Conditional HEADs of a section's files, returning those changed since fetch.py last loaded them."""
+    from fetch import urls # imported here, like the steps runner.py runs
+    files=[url for stage in ['items','series','data'] for url in urls(Namespace(url=args.url,items=None,series=None,data=None),section,stage)]
+    changed=[]
+
+    with metrics.timed('poll',section=section) as entry:
+        for url,response in zip(files,fetch_all(files,args.jobs,'HEAD',headers=lambda x:validators(cache.get(x)),allow_redirects=True)):
+            cached=cache.get(url)
+
+            if response.status_code==304:
+                continue
+
+            if response.status_code//100!=2:
+                raise ValueError("Status code %d returned for URL %s" % (response.status_code,url))
+
+            if cached==None or any(response.headers.get(header) not in [None,cached.get(key)] for header,key in [('ETag','etag'),('Last-Modified','last_modified')]):
+                changed.append(url)
+
+        entry['files'],entry['changed']=len(files),len(changed)
+
+    return changed
+
+def load(args,section):
+    """Run fetch.py for one section and then the steps after it, returning the last failure."""
+    status=0
+
+    for script,*argv in [['fetch']+split(args.fetch)+['--database',args.database,'--cache',args.cache,'--url',args.url,section]]+[split(step.split(':',1)[1]) for step in args.after if step.split(':',1)[0] in [section,'*']]:
+        print("%s: running %s" % (datetime.now().ctime()," ".join([script]+argv)))
+
+        with metrics.timed('step',section=section,step=script) as entry:
+            entry['status']=failed=runner.run(script,argv)
+
+        if failed!=0:
+            stdout.flush()
+            stderr.write("Step %s for LABSTAT section '%s' failed with status %d.\n" % (script,section,failed))
+            status=failed
+
+            if script=='fetch': # nothing new to run the later steps on
+                break
+
+    return status
+
+def main(argv=None):
+    # arguments
+    from argparse import ArgumentParser
+    args=ArgumentParser();
+    args.add_argument("section",type=str,nargs='+',choices=sorted(SECTIONS),help="Sections of LABSTAT to watch.")
+    args.add_argument("-u","--url",type=str,default='https://download.bls.gov/pub/time.series/%s',help="URL for data folder.")
+    args.add_argument("-D","--database",type=str,default="database=Analysis",help='Database connection for fetch.py, whose cache is polled against.')
+    args.add_argument("-C","--cache",type=str,default="%s/.cache/labstat" % getenv("HOME"),help="Folder of fetch.py's conditional download cache.")
+    args.add_argument("-F","--fetch",type=str,default="--update",help="Arguments for fetch.py, which is given the section, --database, --cache and --url.")
+    args.add_argument("-a","--after",type=str,action='append',default=[],help="Step to run after a section loads, as 'section:script arguments', or '*:...' for every section.")
+    args.add_argument("-t","--time",type=str,default='08:30',help="Time of day releases come out.")
+    args.add_argument("-z","--zone",type=str,default='America/New_York',help="Time zone of the release time.")
+    args.add_argument("-w","--window",type=float,default=4,help="Hours after the release time to poll often.")
+    args.add_argument("-f","--fast",type=int,default=60,help="Seconds between polls in a release window.")
+    args.add_argument("-s","--slow",type=int,default=6*3600,help="Seconds between polls outside release windows, and before retrying a load that failed outside them.")
+    args.add_argument("-j","--jobs",type=int,default=8,help="Files to poll at once.")
+    args.add_argument("-1","--once",action='store_true',help="Set to poll every section once, load any that changed, and exit.")
+    args.add_argument("-E","--prometheus",type=str,default=None,help="File to write the metrics of each poll to in the Prometheus textfile format.")
+    args.add_argument("-H","--hidden",action='store_true',help="Prevent arguments and secrets being echoed to the terminal.")
+    args=args.parse_args(argv);
+    args.section=list(dict.fromkeys(args.section)) # in order, without repeats
+
+    # initialize
+    print(__doc__,"\nParameters:",vars(args) if not args.hidden else 'hidden')
+    from fetch import DownloadCache
+    cache=DownloadCache(args.cache,None,identity(dict(map(lambda x:x.split('=',1),args.database.split(';'))))) # the folder fetch.py keeps for the database
+    due,failures,status={section:time() for section in args.section},{section:0 for section in args.section},0
+    connections.pool.keep=True # so loads reuse the connections of earlier ones
+
+    # main code
+    try:
+        while True:
+            metrics.start()
+
+            for section in [section for section in args.section if due[section]<=time()]:
+                start,end=window(args,section,datetime.now(ZoneInfo(args.zone)))
+                inside=start.timestamp()<=time()<end.timestamp()
+
+                try:
+                    changed=poll(args,cache,section)
+
+                except Exception as e:
+                    stdout.flush()
+                    stderr.write("Failed to poll LABSTAT section '%s': %s\n" % (section,str(e)))
+                    metrics.record('failure',section=section,error=str(e).split('\n')[0])
+                    changed=None
+
+                if changed:
+                    print("%s: %d files changed for LABSTAT section '%s': %s" % (datetime.now().ctime(),len(changed),section,", ".join(map(lambda x:x.split('/')[-1],changed))))
+                    failed=load(args,section)
+                    status=failed or status
+
+                else:
+                    failed=0
+
+                # poll again soon in a window, backing off while loads fail but not past its end, and otherwise at the
+                # next window at the latest
+                failures[section]=failures[section]+1 if failed and inside else 0
+
+                if inside:
+                    due[section]=min(time()+args.fast*2**max(failures[section]-1,0),end.timestamp())
+
+                else:
+                    due[section]=min(time()+args.slow,start.timestamp())
+
+            metrics.write(None,args.prometheus,status)
+
+            if args.once:
+                break
+
+            wait=max(min(due.values())-time(),0)
+
+            if wait>args.fast:
+                print("%s: next poll in %.0fs." % (datetime.now().ctime(),wait))
+
+            sleep(wait)
+
+    except KeyboardInterrupt:
+        stdout.flush()
+        stderr.write('Interrupted.\n')
+
+    finally:
+        connections.pool.close()
+
+    # done
+    print("Done.")
+    return status
+
+# bootstrap
+if __name__ == "__main__":
+    assert(version_info.major>=3)
+    exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Registry of the LABSTAT sections that can be loaded, describing their files and column layouts."""
+
+# modules
+from re import findall
+
+# Each section names its item and series metadata files and lists their columns in file order. Columns named after a
+# BLSItems or BLSSeries column are loaded into it, any others are skipped; the section's own item-like code (measure,
+# industry) is named item_code so BLSSeries can reference BLSItems. The data files are either a list of names or a
+# regular expression matched against the section's directory listing. The release gives the days of the month (and, if
+# it is always on one, the weekday) the section's news release is expected on, for scheduler.py.
+SECTIONS={
+    'ap':{
+        'title':'Average Price Data',
+        'items':('ap.item',['item_code','item_name']),
+        'series':('ap.series',['series_id','area_code','item_code','series_title','footnote_codes','begin_year','begin_period','end_year','end_period']),
+        'data':['ap.data.0.Current'],
+        'release':{'days':(10,15)}, # with the CPI
+    },
+    'cu':{
+        'title':'Consumer Price Index - All Urban Consumers',
+        'items':('cu.item',['item_code','item_name','display_level','selectable','sort_sequence']),
+        'series':('cu.series',['series_id','area_code','item_code','seasonal','periodicity_code','base_code','base_period','series_title','footnote_codes','begin_year','begin_period','end_year','end_period']),
+        'data':['cu.data.0.Current'],
+        'release':{'days':(10,15)},
+    },
+    'su':{
+        'title':'Chained Consumer Price Index - All Urban Consumers',
+        'items':('su.item',['item_code','item_name','display_level','selectable','sort_sequence']),
+        'series':('su.series',['series_id','area_code','item_code','seasonal','periodicity_code','base_code','base_period','series_title','footnote_codes','begin_year','begin_period','end_year','end_period']),
+        'data':['su.data.0.Current'],
+        'release':{'days':(10,15)},
+    },
+    'la':{
+        'title':'Local Area Unemployment Statistics',
+        'items':('la.measure',['item_code','item_name']),
+        'series':('la.series',['series_id','area_type_code','area_code','item_code','seasonal','srd_code','series_title','footnote_codes','begin_year','begin_period','end_year','end_period']),
+        'data':r'la\.data\.0\.CurrentU\d{2}-\d{2}',
+        'release':{'days':(15,22)}, # State Employment and Unemployment, metropolitan areas follow later in the month
+    },
+    'ce':{
+        'title':'Current Employment Statistics (National)',
+        'items':('ce.industry',['item_code','naics_code','publishing_status','item_name','display_level','selectable','sort_sequence']),
+        'series':('ce.series',['series_id','supersector_code','item_code','data_type_code','seasonal','series_title','footnote_codes','begin_year','begin_period','end_year','end_period']),
+        'data':['ce.data.0.AllCESSeries'],
+        'release':{'days':(1,7),'weekday':4}, # the Employment Situation, on the first Friday
+    },
+    'sm':{
+        'title':'State and Area Employment, Hours, and Earnings',
+        'items':('sm.industry',['item_code','item_name']),
+        'series':('sm.series',['series_id','state_code','area_code','supersector_code','item_code','data_type_code','seasonal','benchmark_year','footnote_codes','begin_year','begin_period','end_year','end_period']),
+        'data':['sm.data.1.AllData'],
+        'release':{'days':(15,22)}, # State Employment and Unemployment
+    },
+}
+
+# layout shared by every time series file
+DATA=['series_id','year','period','value','footnote_codes']
+
+def columns(section,kind):
+    """Columns, in file order, of a section's items, series or data files."""
+    if kind=='data':
+        return DATA
+
+    if section not in SECTIONS:
+        raise ValueError("Don't know how to load data for BLS LABSTAT section '%s'." % section)
+
+    return SECTIONS[section][kind][1]
+
+def filenames(section,kind,listing=None):
+    """Names of a section's files of a kind; a data file pattern is matched against the directory listing text."""
+    if kind!='data':
+        return [SECTIONS[section][kind][0]]
+
+    data=SECTIONS[section]['data']
+
+    if isinstance(data,list):
+        return data
+
+    if listing==None:
+        raise ValueError("Data files for BLS LABSTAT section '%s' are found from the directory listing." % section)
+
+    return sorted(set(findall(r'/(%s)"' % data,listing))) # the listing links to files by path
+
+def release_day(section,day):
+    """Whether a section's news release is expected on a day (a date), which is always a weekday."""
+    release=SECTIONS[section]['release']
+
+    return day.weekday()<5 and release['days'][0]<=day.day<=release['days'][1] and release.get('weekday',day.weekday())==day.weekday()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Script to list and extract vintages of raw LABSTAT files from the compressed archive fetch.py keeps."""
+
+# modules
+from zstandard import ZstdCompressor,ZstdDecompressor
+from sys import stdout,version_info,exit
+from os import makedirs,listdir,replace,getenv
+from os.path import join,exists,getmtime
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+class Archive:
+    """Folder of vintages of raw files, one per distinct content, as <folder>/<section>/<file>/<vintage>.zst with an
+    index <vintage>.index. Each vintage is a series of independent zstd frames of about framesize bytes that only ever
+    split between keys (the first column, so series_id for time series), and the index gives for each key the offset
+    and size of its frame and where its lines are in the decompressed frame. Reading a few series decompresses only
+    their frames."""
+    def __init__(self,folder,column='\t',level=10,framesize=1<<20):
+        self.folder,self.column,self.level,self.framesize=folder,column.encode(),level,framesize
+
+    def path(self,url):
+        return join(self.folder,*url.rstrip('/').split('/')[-2:])
+
+    def vintages(self,url):
+        """Vintages of a file, oldest first."""
+        path=self.path(url)
+
+        return sorted(name[:-4] for name in listdir(path) if name.endswith('.zst')) if exists(path) else []
+
+    def put(self,url,filename,entry):
+        """Archive a downloaded file as a new vintage unless its content is already archived; returns the vintage."""
+        if any(map(lambda x:x.endswith(entry['sha256'][:12]),self.vintages(url))):
+            return None
+
+        try:
+            stamp=parsedate_to_datetime(entry['last_modified']) if entry.get('last_modified') else datetime.now()
+
+        except (TypeError,ValueError):
+            stamp=datetime.now()
+
+        vintage,path="%s-%s" % (stamp.strftime("%Y%m%dT%H%M%S"),entry['sha256'][:12]),self.path(url)
+        makedirs(path,exist_ok=True)
+        compressor,offset,block,ranges,last=ZstdCompressor(level=self.level),0,[],[],None
+
+        with open(filename,'rb') as rawfile,open(join(path,vintage+".zst.tmp"),'wb') as zstfile,open(join(path,vintage+".index.tmp"),'w') as indexfile:
+            def flush():
+                frame=compressor.compress(b"".join(block))
+                zstfile.write(frame)
+
+                for key,start,length in ranges:
+                    indexfile.write("%s\t%d\t%d\t%d\t%d\n" % (key,offset,len(frame),start,length))
+
+                return offset+len(frame)
+
+            size=0
+
+            for line in rawfile:
+                key=line.split(self.column,1)[0].strip().decode('latin-1')
+
+                if key!=last and size>=self.framesize:
+                    offset,block,ranges,size=flush(),[],[],0
+
+                if key!=last or len(ranges)==0:
+                    ranges.append([key,size,0])
+
+                block.append(line)
+                ranges[-1][2]+=len(line)
+                size+=len(line)
+                last=key
+
+            if len(block)>0:
+                flush()
+
+        replace(join(path,vintage+".index.tmp"),join(path,vintage+".index")) # the index first, so a vintage is never listed without one
+        replace(join(path,vintage+".zst.tmp"),join(path,vintage+".zst"))
+        return vintage
+
+    def index(self,url,vintage):
+        """Ranges of lines by key in a vintage, as (frame offset, frame size, start, length)."""
+        ranges={}
+
+        with open(join(self.path(url),vintage+".index")) as indexfile:
+            for line in indexfile:
+                key,offset,size,start,length=line.rstrip('\n').split('\t')
+                ranges.setdefault(key,[]).append((int(offset),int(size),int(start),int(length)))
+
+        return ranges
+
+    def read(self,url,vintage,keys=None):
+        """Yield the raw lines of a vintage, all of them or only those of some keys (in file order), decompressing only
+        the frames they are in."""
+        decompressor,index,frames=ZstdDecompressor(),self.index(url,vintage),{}
+
+        with open(join(self.path(url),vintage+".zst"),'rb') as zstfile:
+            for key in index if keys==None else keys:
+                for offset,size,start,length in index.get(key,[]):
+                    frames.setdefault((offset,size),[]).append((start,length))
+
+            for (offset,size),slices in sorted(frames.items()):
+                zstfile.seek(offset)
+                frame=decompressor.decompress(zstfile.read(size))
+
+                for start,length in sorted(slices):
+                    yield frame[start:start+length]
+
+def main():
+    # arguments
+    from argparse import ArgumentParser
+    args=ArgumentParser();
+    args.add_argument("file",type=str,help="File to list or extract vintages of, as section/name, e.g. cu/cu.data.0.Current.")
+    args.add_argument("-A","--archive",type=str,default="%s/.cache/labstat/vintages" % getenv("HOME"),help="Folder of the archive.")
+    args.add_argument("-v","--vintage",type=str,default=None,help="Vintage to extract (defaults to the latest), or 'list' to list them.")
+    args.add_argument("-s","--series",type=str,default=None,help="Comma separated series ids to extract (defaults to the whole file).")
+    args=args.parse_args();
+
+    # main code
+    archive=Archive(args.archive)
+    vintages=archive.vintages(args.file)
+
+    if len(vintages)==0:
+        raise ValueError("No vintages of %s in %s." % (args.file,args.archive))
+
+    if args.vintage=='list':
+        for vintage in vintages:
+            path=join(archive.path(args.file),vintage)
+            print("%s\t%d keys\tarchived %s" % (
+                vintage,
+                len(archive.index(args.file,vintage)),
+                datetime.fromtimestamp(getmtime(path+".zst")).isoformat()
+            ))
+
+        return 0
+
+    vintage=args.vintage or vintages[-1]
+
+    if args.series==None:
+        lines=archive.read(args.file,vintage)
+
+    else: # with the header line, so the output loads like the original file
+        header=next(archive.read(args.file,vintage)).split(b'\n',1)[0]+b'\n'
+        stdout.buffer.write(header)
+        lines=archive.read(args.file,vintage,args.series.split(','))
+
+    for chunk in lines:
+        stdout.buffer.write(chunk)
+
+    return 0
+
+# bootstrap
+if __name__ == "__main__":
+    assert(version_info.major>=3)
+    exit(main())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#encoding: UTF-8
+"""Read-only streaming reader of xlsx worksheets, straight from the zip and its XML with the standard library."""
+
+# modules
+from zipfile import ZipFile
+from xml.etree.ElementTree import iterparse
+from posixpath import join,normpath
+from re import match
+
+MAIN="{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELATIONSHIPS="{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PACKAGE="{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+def column(reference):
+    """0 offset column of a cell reference, e.g. 2 for 'C7'."""
+    n=0
+
+    for letter in match(r"[A-Z]+",reference).group(0):
+        n=n*26+ord(letter)-64
+
+    return n-1
+
+def text(element):
+    """Text of a string item or inline string, joining its rich text runs but not their phonetic readings."""
+    return "".join(t.text or "" for t in element.findall(MAIN+"t")+element.findall("%sr/%st" % (MAIN,MAIN)))
+
+def sheet(archive,index):
+    """Path in the zip of the worksheet at an index, in workbook order."""
+    with archive.open("xl/workbook.xml") as workbook:
+        sheets=[element.get(RELATIONSHIPS+"id") for event,element in iterparse(workbook) if element.tag==MAIN+"sheet"]
+
+    with archive.open("xl/_rels/workbook.xml.rels") as relationships:
+        targets={element.get("Id"):element.get("Target") for event,element in iterparse(relationships) if element.tag==PACKAGE+"Relationship"}
+
+    target=targets[sheets[index]]
+
+    return target.lstrip("/") if target.startswith("/") else normpath(join("xl",target))
+
+def strings(archive):
+    """The shared strings table, in order."""
+    if "xl/sharedStrings.xml" not in archive.namelist():
+        return []
+
+    table=[]
+
+    with archive.open("xl/sharedStrings.xml") as shared:
+        for event,element in iterparse(shared):
+            if element.tag==MAIN+"si":
+                table.append(text(element))
+                element.clear()
+
+    return table
+
+def rows(filename,index=0,columns=None):
+    """Yield (row, values) for each row of a worksheet in order, the row 0 offset and values a dict by 0 offset column of
+    numbers (as float), booleans and strings (ISO 8601 for date cells), of only the given columns if any. Empty cells are
+    left out, formulas give their cached value, and only one row is held in memory at a time."""
+    keep=set(columns) if columns!=None else None
+
+    with ZipFile(filename) as archive:
+        table=strings(archive)
+
+        with archive.open(sheet(archive,index)) as worksheet:
+            values,n,last={},0,-1
+
+            for event,element in iterparse(worksheet):
+                if element.tag==MAIN+"c":
+                    c=column(element.get("r")) if element.get("r")!=None else n
+                    n,kind,v=c+1,element.get("t","n"),element.find(MAIN+"v")
+
+                    if keep==None or c in keep:
+                        if kind=="inlineStr" and element.find(MAIN+"is")!=None:
+                            values[c]=text(element.find(MAIN+"is"))
+
+                        elif v!=None and v.text!=None:
+                            values[c]=table[int(v.text)] if kind=="s" else float(v.text) if kind=="n" else bool(int(v.text)) if kind=="b" else v.text # str, e and d (an ISO 8601 date) as text
+
+                    element.clear()
+
+                elif element.tag==MAIN+"row":
+                    last=int(element.get("r"))-1 if element.get("r")!=None else last+1
+                    yield last,values
+                    values,n={},0
+                    element.clear()